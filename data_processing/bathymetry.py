@@ -0,0 +1,285 @@
+"""
+Level of detail meshes of the ring bathymetry.
+
+The lon/lat/depth tsv is put onto a regular lon/lat grid once, and
+coarser levels are made by averaging 2x2 blocks of the level below. The
+levels are saved to an npz file in the cache directory, so later runs
+only load the grids. Meshes are triangulated directly from the grid
+(two triangles per cell), instead of plotly triangulating scattered points.
+
+Pick a level by how many vertices the browser should get, optionally only
+counting (and drawing) a region of interest:
+    lod = bathymetry.BathymetryLOD.cached(mesh_file, cache_dir)
+    mesh = lod.mesh(max_vertices=20000, region=(lon_min, lon_max, lat_min, lat_max))
+
+Example command line (builds the levels ahead of time and prints their sizes):
+    python bathymetry.py --mesh_file ../data/ring_depth.csv --cache_dir ../data/.cache
+"""
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+import cache
+import conversions
+
+# Default bathymetry tsv
+MESH_PATH = "../data/ring_depth.csv"
+
+# Bump whenever the way levels are built changes
+LOD_VERSION = 2
+
+# Largest side of the finest grid
+MAX_GRID_SIZE = 2048
+
+# Levels stop once the coarsest has fewer than this many cells on a side
+MIN_GRID_SIZE = 8
+
+# Data keeps its own grid only when its points fill at least this fraction of it
+GRID_FILL = .5
+
+
+def read_mesh_file(path):
+    """Reads a tsv file with longitude, latitude, and depth columns"""
+    return pd.read_csv(path, header=None, names = ['lon', 'lat', 'depth'], sep='\t')
+
+
+def _grid_axis(values, size, unique=None):
+    """Grid coordinates for one axis, and the grid position of each value.
+    Given the axis' unique values those are the grid, otherwise the values
+    are binned evenly into size cells."""
+    if unique is not None:
+        return unique, np.searchsorted(unique, values)
+
+    edges = np.linspace(np.min(values), np.max(values), size + 1)
+    positions = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, size - 1)
+    return (edges[:-1] + edges[1:])/2, positions
+
+
+def grid_bathymetry(lon, lat, depth, max_size=MAX_GRID_SIZE):
+    """Averages scattered depths onto a regular grid, shaped (lat, lon),
+    with NaN wherever there's no data.
+
+    Data that already lies on a grid (its points filling most of it) keeps
+    that grid. Anything else, like scattered soundings with rounded
+    coordinates, is binned to about sqrt(points) cells a side, so the
+    cells are mostly filled and there's something to triangulate."""
+    unique_lon, unique_lat = np.unique(lon), np.unique(lat)
+    points = len(np.unique(np.stack([lon, lat], axis=1), axis=0))
+    gridded = (
+        len(unique_lon) <= max_size
+        and len(unique_lat) <= max_size
+        and points >= GRID_FILL * len(unique_lon) * len(unique_lat)
+    )
+
+    size = int(np.clip(np.ceil(np.sqrt(points)), 1, max_size))
+    lon_grid, lon_positions = _grid_axis(lon, size, unique_lon if gridded else None)
+    lat_grid, lat_positions = _grid_axis(lat, size, unique_lat if gridded else None)
+
+    cells = lat_positions * len(lon_grid) + lon_positions
+    size = len(lat_grid) * len(lon_grid)
+    sums = np.bincount(cells, weights=depth, minlength=size)
+    counts = np.bincount(cells, minlength=size)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        grid = sums / counts
+    return lon_grid, lat_grid, grid.reshape(len(lat_grid), len(lon_grid))
+
+
+def _coarsen_axis(coordinates):
+    if len(coordinates) % 2:
+        step = coordinates[-1] - coordinates[-2] if len(coordinates) > 1 else 0
+        coordinates = np.append(coordinates, coordinates[-1] + step)
+    return (coordinates[0::2] + coordinates[1::2])/2
+
+
+def coarsen(lon, lat, depth):
+    """Halves the resolution of a grid by averaging 2x2 blocks, ignoring NaN"""
+    height, width = depth.shape
+    padded = np.full((height + height % 2, width + width % 2), np.nan)
+    padded[:height, :width] = depth
+
+    blocks = padded.reshape(padded.shape[0]//2, 2, padded.shape[1]//2, 2)
+    valid = ~np.isnan(blocks)
+    sums = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    counts = valid.sum(axis=(1, 3))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coarse = sums / counts
+    return _coarsen_axis(lon), _coarsen_axis(lat), coarse
+
+
+def triangulate(depth):
+    """Vertex positions (into the flattened grid) of every valid grid point,
+    and i, j, k indices into those vertices for two triangles per grid cell"""
+    height, width = depth.shape
+    valid = ~np.isnan(depth).ravel()
+    vertices = np.flatnonzero(valid)
+
+    # Maps grid positions to vertex numbers
+    numbering = np.cumsum(valid) - 1
+
+    rows, columns = np.meshgrid(np.arange(height - 1), np.arange(width - 1), indexing='ij')
+    corner = (rows * width + columns).ravel()
+    right, below, diagonal = corner + 1, corner + width, corner + width + 1
+
+    triangles = np.concatenate([
+        np.stack([corner, right, below], axis=1),
+        np.stack([right, diagonal, below], axis=1),
+    ])
+    triangles = triangles[valid[triangles].all(axis=1)]
+    return vertices, numbering[triangles]
+
+
+def _span(coordinates, low, high):
+    # Includes the grid points just outside, so the mesh covers the whole region
+    start = max(np.searchsorted(coordinates, low, side='right') - 1, 0)
+    stop = np.searchsorted(coordinates, high, side='left') + 1
+    return slice(start, stop)
+
+
+class BathymetryLOD():
+    """
+    A pyramid of bathymetry grids, finest first.
+
+    levels : list of (lon, lat, depth) with 1D lon and lat coordinates and
+             depth shaped (len(lat), len(lon))
+    """
+    def __init__(self, levels):
+        self.levels = levels
+
+    @classmethod
+    def from_file(cls, path, max_size=MAX_GRID_SIZE, min_size=MIN_GRID_SIZE):
+        ring_depth = read_mesh_file(path)
+        ring_depth = ring_depth[ring_depth.depth.notna()]
+
+        level = grid_bathymetry(
+            ring_depth.lon.to_numpy(np.float64),
+            ring_depth.lat.to_numpy(np.float64),
+            ring_depth.depth.to_numpy(np.float64),
+            max_size
+        )
+        levels = [level]
+        while min(level[2].shape) >= 2*min_size:
+            level = coarsen(*level)
+            levels.append(level)
+        return cls(levels)
+
+    @classmethod
+    def load(cls, lod_path):
+        with np.load(lod_path) as lod:
+            count = int(lod['count'])
+            return cls([
+                (lod[f'lon_{n}'], lod[f'lat_{n}'], lod[f'depth_{n}'])
+                for n
+                in range(count)
+            ])
+
+    def save(self, lod_path):
+        arrays = {'count': len(self.levels)}
+        for n, (lon, lat, depth) in enumerate(self.levels):
+            arrays.update({f'lon_{n}': lon, f'lat_{n}': lat, f'depth_{n}': depth})
+
+        # Moved into place once written, like the parse cache
+        temp_path = f"{lod_path}.{os.getpid()}.tmp.npz"
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, lod_path)
+
+    @classmethod
+    def cached(cls, path, cache_dir=None):
+        """Loads the levels for a bathymetry tsv from cache_dir,
+        building and saving them first if the tsv is new or has changed"""
+        if cache_dir is None:
+            return cls.from_file(path)
+
+        description = json.dumps([cache.fingerprint(path), LOD_VERSION, MAX_GRID_SIZE, MIN_GRID_SIZE])
+        key = hashlib.sha1(description.encode()).hexdigest()
+        lod_path = os.path.join(cache_dir, f"{key}.lod.npz")
+
+        if os.path.exists(lod_path):
+            return cls.load(lod_path)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        lod = cls.from_file(path)
+        lod.save(lod_path)
+        return lod
+
+    def _window(self, level, region):
+        lon, lat, depth = self.levels[level]
+        if region is None:
+            return lon, lat, depth
+
+        lon_min, lon_max, lat_min, lat_max = region
+        lon_keep = _span(lon, lon_min, lon_max)
+        lat_keep = _span(lat, lat_min, lat_max)
+        return lon[lon_keep], lat[lat_keep], depth[lat_keep, lon_keep]
+
+    def vertex_count(self, level, region=None):
+        return int(np.count_nonzero(~np.isnan(self._window(level, region)[2])))
+
+    def triangle_count(self, level, region=None):
+        return len(triangulate(self._window(level, region)[2])[1])
+
+    def choose_level(self, max_vertices, region=None):
+        """The finest level with at most max_vertices (in the region) that has
+        any triangles to draw, or the coarsest"""
+        for level in range(len(self.levels)):
+            if self.vertex_count(level, region) <= max_vertices and self.triangle_count(level, region):
+                return level
+        return len(self.levels) - 1
+
+    def _coordinates(self, level, region, use_utm):
+        lon, lat, depth = self._window(level, region)
+        lon, lat = np.meshgrid(lon, lat)
+        if not use_utm:
+            return lon, lat, depth
+
+        # Same order as the dive data, so the mesh lines up with it
+        northing, easting = conversions.latlon_to_utm(lat.ravel(), lon.ravel())
+        return northing.reshape(lon.shape), easting.reshape(lon.shape), depth
+
+    def mesh(self, max_vertices=20000, region=None, use_utm=True, level=None):
+        """A go.Mesh3d of the chosen level, triangulated from the grid
+
+        region : (lon_min, lon_max, lat_min, lat_max) to draw, defaults to everything
+        level : use this level instead of choosing by max_vertices"""
+        if level is None:
+            level = self.choose_level(max_vertices, region)
+
+        x, y, depth = self._coordinates(level, region, use_utm)
+        vertices, triangles = triangulate(depth)
+        return go.Mesh3d(
+            x=x.ravel()[vertices],
+            y=y.ravel()[vertices],
+            z=depth.ravel()[vertices],
+            i=triangles[:, 0],
+            j=triangles[:, 1],
+            k=triangles[:, 2],
+            opacity=.5
+        )
+
+    def surface(self, max_vertices=20000, region=None, use_utm=True, level=None):
+        """A go.Surface of the chosen level, gaps in the data are left open"""
+        if level is None:
+            level = self.choose_level(max_vertices, region)
+
+        x, y, depth = self._coordinates(level, region, use_utm)
+        return go.Surface(x=x, y=y, z=depth, opacity=.5, showscale=False)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mesh_file', default=MESH_PATH, type=str, help="Bathymetry tsv (lon, lat, depth)")
+    parser.add_argument('--cache_dir', required=True, type=str, help="Where to keep the levels")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    lod = BathymetryLOD.cached(args.mesh_file, args.cache_dir)
+    for level, (lon, lat, depth) in enumerate(lod.levels):
+        print(f"Level {level}: {depth.shape[1]} x {depth.shape[0]} grid, {lod.vertex_count(level)} vertices")
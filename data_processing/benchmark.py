@@ -0,0 +1,331 @@
+"""
+Times each stage of the pipeline on a dive (usually one from synthetic_data.py),
+recording wall time and peak memory, and saves the results as json so runs
+from different versions can be compared.
+
+Every stage runs in a fresh process, so one stage's imports, caches and
+memory don't count towards the next. A stage has an untimed setup (such as
+loading the table the apps would already have in memory) and the timed run,
+and the peak RSS is taken both after setup and after the run.
+
+Example commands:
+    python synthetic_data.py --out_dir ../data/synthetic
+    python benchmark.py --data_dir ../data/synthetic --output_file before.json
+    ... make changes ...
+    python benchmark.py --data_dir ../data/synthetic --output_file after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+
+# Ratio of wall times (or peak RSS) beyond which a compared stage is flagged
+REGRESSION_THRESHOLD = 1.1
+
+
+def peak_rss_mb():
+    """The peak resident memory of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on linux, bytes on macOS
+    return peak / (1e6 if sys.platform == 'darwin' else 1e3)
+
+
+def _day_files(data_dir):
+    import combine_data
+    return [
+        path
+        for day in combine_data.get_days(data_dir)
+        for path in combine_data.get_day_paths(data_dir, day).values()
+    ]
+
+
+def _combined_path(args):
+    """The combined csv for the dive, made (untimed) if it isn't there yet"""
+    import combine_data
+    import dive_store
+    path = os.path.join(args.work_dir, 'combined.csv')
+    if not os.path.exists(path):
+        data = combine_data.combine(args.data_dir, os.path.join(args.data_dir, 'methane.csv'))
+        dive_store.write_dataset(data, path)
+    return path
+
+
+# Each stage takes the parsed arguments, does any setup,
+# and returns the function that's timed
+
+def stage_load_from_file(args):
+    import utils
+    paths = _day_files(args.data_dir)
+    return lambda: [utils.load_from_file(path) for path in paths]
+
+
+def stage_get_csv_and_navest(args):
+    import combine_data
+    return lambda: combine_data.get_csv_and_navest(args.data_dir)
+
+
+def stage_combine(args):
+    import combine_data
+    import dive_store
+    methane_path = os.path.join(args.data_dir, 'methane.csv')
+    output_file = os.path.join(args.work_dir, 'combine.csv')
+    return lambda: dive_store.write_dataset(combine_data.combine(args.data_dir, methane_path), output_file)
+
+
+def stage_combine_chunked(args):
+    import combine_data
+    methane_path = os.path.join(args.data_dir, 'methane.csv')
+    output_file = os.path.join(args.work_dir, 'combine_chunked.csv')
+    return lambda: combine_data.combine_chunked(args.data_dir, methane_path, output_file, args.chunk_rows)
+
+
+def stage_get_wide_data(args):
+    import mass_spec_utils
+    return lambda: mass_spec_utils.get_wide_data(os.path.join(args.data_dir, 'mass_spec'))
+
+
+def stage_get_mesh(args):
+    import utils
+    return lambda: utils.get_mesh(os.path.join(args.data_dir, 'ring_depth.tsv'))
+
+
+def stage_read_dataset(args):
+    import dive_store
+    path = _combined_path(args)
+    return lambda: dive_store.read_dataset(path, filters=[('depth', '<', -1700)])
+
+
+def stage_callbacks(args):
+    """The work behind the apps' callbacks: a click (sensor readout and a spectrum
+    in each mode) and a timeline zoom (picking the points to draw)"""
+    import dive_store
+    import decimation
+    import data_service
+    import mass_spec_utils
+
+    near_vent = dive_store.read_dataset(_combined_path(args), filters=[('depth', '<', -1700)])
+    service = data_service.DataService(near_vent)
+    spectra = mass_spec_utils.SpectrumServer(
+        mass_spec_utils.load_mass_spec(os.path.join(args.data_dir, 'mass_spec'))
+    )
+
+    rng = np.random.default_rng(0)
+    labels = rng.choice(near_vent.index.to_numpy(), args.clicks)
+    times = near_vent.unix_time.to_numpy()
+    starts = rng.uniform(times.min(), times.max(), args.clicks)
+    views = [(start, start + rng.uniform(60, times.max() - times.min())) for start in starts]
+
+    def click(label):
+        service.readout(label)
+        for mode in spectra.MODES:
+            spectra.figure(service.value(label, 'unix_time'), mode, 10)
+
+    def zoom(view):
+        in_view = decimation.in_view(near_vent.unix_time, view)
+        points = near_vent.iloc[in_view]
+        decimation.voxel(points.northing, points.easting, points.depth, 5000)
+        decimation.minmax(points.unix_time, points.depth, 5000)
+
+    def run():
+        return {
+            'click_ms': _latencies(click, labels),
+            'zoom_ms': _latencies(zoom, views),
+        }
+    return run
+
+
+def _latencies(func, inputs):
+    latencies = []
+    for value in inputs:
+        start = time.perf_counter()
+        func(value)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        'mean': float(np.mean(latencies)),
+        'p95': float(np.percentile(latencies, 95)),
+        'max': float(np.max(latencies)),
+    }
+
+
+STAGES = {
+    'load_from_file': stage_load_from_file,
+    'get_csv_and_navest': stage_get_csv_and_navest,
+    'combine': stage_combine,
+    'combine_chunked': stage_combine_chunked,
+    'get_wide_data': stage_get_wide_data,
+    'get_mesh': stage_get_mesh,
+    'read_dataset': stage_read_dataset,
+    'callbacks': stage_callbacks,
+}
+
+
+def run_stage(name, args):
+    """Runs one stage in this process, returning its measurements"""
+    run = STAGES[name](args)
+    setup_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    details = run()
+    wall = time.perf_counter() - start
+
+    result = {'wall_seconds': wall, 'setup_rss_mb': setup_rss, 'peak_rss_mb': peak_rss_mb()}
+    if isinstance(details, dict):
+        result['details'] = details
+    return result
+
+
+def measure_stage(name, args):
+    """Runs a stage args.repeat times, each in a fresh process, keeping
+    the fastest wall time and the largest peak RSS"""
+    runs = []
+    for _ in range(args.repeat):
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            result_file = f.name
+        try:
+            command = [
+                sys.executable, os.path.abspath(__file__),
+                '--data_dir', args.data_dir,
+                '--work_dir', args.work_dir,
+                '--chunk_rows', str(args.chunk_rows),
+                '--clicks', str(args.clicks),
+                '--run_stage', name,
+                '--result_file', result_file,
+            ]
+            # Stages print progress of their own, which isn't wanted here
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                raise RuntimeError(f"Stage {name} failed:\n{completed.stderr}")
+            with open(result_file) as f:
+                runs.append(json.load(f))
+        finally:
+            os.remove(result_file)
+
+    return {
+        'wall_seconds': min(run['wall_seconds'] for run in runs),
+        'wall_seconds_all': [run['wall_seconds'] for run in runs],
+        'setup_rss_mb': max(run['setup_rss_mb'] for run in runs),
+        'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+        **({'details': runs[0]['details']} if 'details' in runs[0] else {}),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scale(data_dir):
+    """The parameters of a synthetic dive, or None for any other data"""
+    path = os.path.join(data_dir, 'synthetic.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, previous, threshold=REGRESSION_THRESHOLD):
+    """Prints each stage's wall time and peak RSS against a previous run"""
+    if previous.get('scale') != results.get('scale'):
+        print("Warning, the runs are on data of a different scale")
+
+    print(f"{'stage':20s} {'wall (s)':>22s} {'peak rss (MB)':>24s}")
+    for name, stage in results['stages'].items():
+        before = previous['stages'].get(name)
+        if before is None:
+            print(f"{name:20s} {stage['wall_seconds']:22.3f} {stage['peak_rss_mb']:24.1f}")
+            continue
+
+        wall_ratio = stage['wall_seconds'] / max(before['wall_seconds'], 1e-9)
+        rss_ratio = stage['peak_rss_mb'] / max(before['peak_rss_mb'], 1e-9)
+        flag = "  REGRESSION" if wall_ratio > threshold or rss_ratio > threshold else ""
+        print(
+            f"{name:20s} "
+            f"{before['wall_seconds']:8.3f} -> {stage['wall_seconds']:8.3f} ({wall_ratio:4.2f}x) "
+            f"{before['peak_rss_mb']:8.1f} -> {stage['peak_rss_mb']:8.1f} ({rss_ratio:4.2f}x)"
+            f"{flag}"
+        )
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', required=True, type=str,
+        help="Dive to run on, laid out as synthetic_data.py writes it")
+    parser.add_argument('--output_file', default=None, type=str, help="Where to save the results as json")
+    parser.add_argument('--compare', default=None, type=str, help="Results of a previous run to compare against")
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES), help="Stages to run")
+    parser.add_argument('--repeat', default=1, type=int, help="Runs of each stage, the fastest is kept")
+    parser.add_argument('--work_dir', default=None, type=str,
+        help="Directory for stage outputs, defaults to a temporary directory")
+    parser.add_argument('--chunk_rows', default=10000, type=int, help="Chunk size for the combine_chunked stage")
+    parser.add_argument('--clicks', default=50, type=int, help="Clicks (and zooms) timed in the callbacks stage")
+    parser.add_argument('--threshold', default=REGRESSION_THRESHOLD, type=float,
+        help="Ratio to a compared run beyond which a stage is flagged")
+
+    # Used internally to run a single stage in a child process
+    parser.add_argument('--run_stage', default=None, choices=list(STAGES), help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--prepare', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    if args.prepare:
+        _combined_path(args)
+        sys.exit()
+
+    if args.run_stage is not None:
+        with open(args.result_file, 'w') as f:
+            json.dump(run_stage(args.run_stage, args), f)
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        if args.work_dir is None:
+            args.work_dir = temporary_dir
+        os.makedirs(args.work_dir, exist_ok=True)
+
+        results = {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'data_dir': os.path.abspath(args.data_dir),
+            'scale': scale(args.data_dir),
+            'stages': {},
+        }
+        # Made up front (in a child, as children start with their parent's
+        # peak RSS), so it isn't part of any stage's memory
+        if {'read_dataset', 'callbacks'} & set(args.stages):
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--data_dir', args.data_dir,
+                 '--work_dir', args.work_dir, '--prepare'],
+                capture_output=True, check=True
+            )
+
+        for name in args.stages:
+            results['stages'][name] = measure_stage(name, args)
+            stage = results['stages'][name]
+            print(f"{name:20s} {stage['wall_seconds']:8.3f} s {stage['peak_rss_mb']:8.1f} MB")
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f), args.threshold)
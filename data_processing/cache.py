@@ -0,0 +1,252 @@
+"""
+A content addressed cache for parsed data streams.
+
+Each parsed stream is stored as an uncompressed feather file, keyed on the
+source path, size and modification time along with the parser used, so
+later runs memory map the parsed columns instead of parsing text again.
+
+The cache can be managed from the command line, for example:
+    python cache.py --cache_dir ../data/.cache inspect
+    python cache.py --cache_dir ../data/.cache prune --max_mb 2000
+    python cache.py --cache_dir ../data/.cache invalidate --source ../data/J2-1393
+"""
+import os
+import json
+import time
+import inspect
+import hashlib
+import argparse
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# Bump whenever the output of a cached parser changes,
+# so that stale entries are never served
+PARSER_VERSION = 5
+
+# Original column names are kept in the schema metadata, since
+# feather only allows string column names (the mass spec columns are floats)
+COLUMNS_METADATA_KEY = b'ring_vent_columns'
+
+# DataFrame.attrs (such as the sensor_formats validation stats) are kept there too
+ATTRS_METADATA_KEY = b'ring_vent_attrs'
+
+
+def fingerprint(path):
+    """Identifies the current contents of a file (or every visible
+    file under a directory) by absolute path, size and modification time."""
+    path = os.path.abspath(path)
+
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [path, stat.st_size, stat.st_mtime_ns]
+
+    # Walks subdirectories too, for partitioned datasets
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for filename in sorted(files):
+            if filename.startswith('.'):
+                continue
+            file_path = os.path.join(root, filename)
+            stat = os.stat(file_path)
+            entries.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+    return [path, entries]
+
+
+def parser_name(parser):
+    """Names a parser by the file it's defined in, rather than its module, which
+    is __main__ when that file is run as a script. Otherwise the same parse would
+    be cached under different keys depending on the entry point."""
+    module = os.path.splitext(os.path.basename(inspect.getfile(parser)))[0]
+    return f"{module}.{parser.__qualname__}"
+
+
+class ParseCache():
+    """
+    A directory of feather files, each with a json sidecar describing
+    where it came from. The modification time of the feather file
+    doubles as the last time it was used, for pruning.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path, parser, args=(), kwargs=None):
+        description = json.dumps([
+            fingerprint(path),
+            parser_name(parser),
+            repr(args),
+            repr(sorted((kwargs or {}).items())),
+            PARSER_VERSION
+        ])
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def _data_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.feather")
+
+    def _info_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, path, parser, *args, **kwargs):
+        """Returns parser(path, *args, **kwargs), reading it from
+        the cache when the source hasn't changed since it was stored."""
+        key = self.key(path, parser, args, kwargs)
+        data_path = self._data_path(key)
+
+        if os.path.exists(data_path):
+            data = self.read(data_path)
+            os.utime(data_path)
+            return data
+
+        data = parser(path, *args, **kwargs)
+        self.write(key, data, {
+            'source': os.path.abspath(path),
+            'parser': parser_name(parser),
+            'created': time.time(),
+        })
+        return data
+
+    def read(self, data_path):
+        table = feather.read_table(data_path, memory_map=True)
+        data = table.to_pandas(split_blocks=True)
+
+        metadata = table.schema.metadata or {}
+        if COLUMNS_METADATA_KEY in metadata:
+            data.columns = json.loads(metadata[COLUMNS_METADATA_KEY])
+        if ATTRS_METADATA_KEY in metadata:
+            data.attrs = json.loads(metadata[ATTRS_METADATA_KEY])
+        return data
+
+    def write(self, key, data, info):
+        columns = data.columns.tolist()
+        stored = data.rename(columns=str) if any(not isinstance(c, str) for c in columns) else data
+
+        table = pa.Table.from_pandas(stored)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            COLUMNS_METADATA_KEY: json.dumps(columns).encode(),
+            ATTRS_METADATA_KEY: json.dumps(data.attrs).encode(),
+        })
+
+        # Written under a temporary name and moved into place so that
+        # parallel workers never see a partially written entry
+        data_path = self._data_path(key)
+        temp_path = f"{data_path}.{os.getpid()}.tmp"
+        feather.write_feather(table, temp_path, compression='uncompressed')
+
+        with open(self._info_path(key), 'w') as f:
+            json.dump(info, f)
+        os.replace(temp_path, data_path)
+
+    def entries(self):
+        """Every entry in the cache, most recently used first."""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith('.feather'):
+                continue
+            key = filename[:-len('.feather')]
+            stat = os.stat(self._data_path(key))
+
+            try:
+                with open(self._info_path(key)) as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                info = {}
+
+            entries.append({
+                'key': key,
+                'bytes': stat.st_size,
+                'last_used': stat.st_mtime,
+                **info
+            })
+
+        entries.sort(key=lambda entry: entry['last_used'], reverse=True)
+        return entries
+
+    def remove(self, key):
+        for path in [self._data_path(key), self._info_path(key)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def prune(self, max_bytes):
+        """Removes the least recently used entries until
+        the cache takes up at most max_bytes. Returns the removed entries."""
+        removed = []
+        total = 0
+        for entry in self.entries():
+            total += entry['bytes']
+            if total > max_bytes:
+                self.remove(entry['key'])
+                removed.append(entry)
+        return removed
+
+    def invalidate(self, source=None):
+        """Removes every entry parsed from source (a file, or anything
+        under a directory), or the entire cache if no source is given."""
+        removed = []
+        if source is not None:
+            source = os.path.abspath(source)
+
+        for entry in self.entries():
+            entry_source = entry.get('source', '')
+            if (
+                source is None
+                or entry_source == source
+                or entry_source.startswith(source + os.sep)
+            ):
+                self.remove(entry['key'])
+                removed.append(entry)
+        return removed
+
+
+def cached_load(cache_dir, parser, path, *args, **kwargs):
+    """Calls parser(path, *args, **kwargs) through the cache
+    in cache_dir, or directly when cache_dir is None."""
+    if cache_dir is None:
+        return parser(path, *args, **kwargs)
+    return ParseCache(cache_dir).load(path, parser, *args, **kwargs)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache_dir', required=True, type=str, help="The cache directory to manage")
+
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('inspect', help="List cached entries, most recently used first")
+
+    prune = commands.add_parser('prune', help="Remove least recently used entries beyond a size budget")
+    prune.add_argument('--max_mb', required=True, type=float, help="Size budget for the cache in megabytes")
+
+    invalidate = commands.add_parser('invalidate', help="Remove entries for a source, or everything")
+    invalidate.add_argument('--source', type=str, default=None,
+        help="File or directory whose entries should be removed (defaults to all)")
+
+    return parser.parse_args()
+
+
+def print_entries(entries):
+    for entry in entries:
+        last_used = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_used']))
+        print(f"{entry['key'][:12]}  {entry['bytes']/1e6:10.2f} MB  {last_used}  "
+              f"{entry.get('parser', '?')}  {entry.get('source', '?')}")
+
+
+if __name__ == '__main__':
+    args = get_args()
+    parse_cache = ParseCache(args.cache_dir)
+
+    if args.command == 'inspect':
+        entries = parse_cache.entries()
+        print_entries(entries)
+        print(f"{len(entries)} entries, {sum(e['bytes'] for e in entries)/1e6:.2f} MB")
+
+    elif args.command == 'prune':
+        removed = parse_cache.prune(args.max_mb * 1e6)
+        print_entries(removed)
+        print(f"Removed {len(removed)} entries")
+
+    elif args.command == 'invalidate':
+        removed = parse_cache.invalidate(args.source)
+        print_entries(removed)
+        print(f"Removed {len(removed)} entries")
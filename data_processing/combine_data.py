@@ -1,15 +1,25 @@
-from scipy.interpolate import interp1d
 import utils
+import fusion
+import cache
+import dive_store
+import mass_spec_utils
+import numpy as np
 import pandas as pd
-import utm
 import os
+import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 # This can be changeable for whatever 
 # DATA_DIR = "../data/J2-1393"
 
 extensions = ['csv', 'ct2', 'oos', 'obs']
 
+RENAV_FILE = "navest/J2-1393_renav.ppi"
+
+# Records the inputs behind an output file, stored next to it
+MANIFEST_SUFFIX = ".manifest.json"
+
 def get_file_names(data_dir):
     # Each "file format" has these days. I want the prefix 
     # that works for each, in order, without the suffix, so I can
@@ -21,100 +31,110 @@ def get_file_names(data_dir):
     # This prevents them from messing up the processing
     return [filepath.split('.')[0] for filepath in files if not filepath.startswith('.')]
 
-def aggregate_data(data_dir, file_day):
-    file_paths = {
+def get_day_paths(data_dir, file_day):
+    return {
         extension:f"{data_dir}/{extension}/{file_day}.{extension.upper()}" 
         for extension 
         in extensions
     }
 
+def aggregate_data(data_dir, file_day, cache_dir=None, max_interp_gap=None, max_asof_gap=None):
+    """Joins the sensor streams for one day onto the csv's clock.
+
+    max_interp_gap : if given, OBS and oxygen aren't interpolated across (or 
+                    extrapolated past) gaps in their readings longer than this many seconds
+    max_asof_gap : if given, CT2 readings older than this many seconds aren't used"""
+    file_paths = get_day_paths(data_dir, file_day)
+
     raw_data = {
-        ext : utils.load_from_file(path)
+        ext : cache.cached_load(cache_dir, utils.load_from_file, path)
         for (ext, path)
         in file_paths.items()
     }
 
-    # Give a standardized time for each datastream to allow for joining later
-    raw_data['ct2']['unix_time'] = raw_data['ct2'].apply(
-        lambda row: utils.date_time_to_unix(row['date'], row['time']), 
-        axis=1
-    )
-
-    raw_data['oos']['unix_time'] = raw_data['oos'].apply(
-        lambda row: utils.date_time_to_unix(row['date'], row['time']), 
-        axis=1
-    )
-
-    raw_data['obs']['unix_time'] = raw_data['obs'].apply(
-        lambda row: utils.date_time_to_unix(row['date'], row['time']), 
-        axis=1
-    )
-
-    raw_data['csv']['unix_time'] = raw_data['csv']['time(seconds since Jan 1 1970)']
-
+    # Every stream is read with a standardized unix_time to allow for joining
     combined_data = raw_data['csv']
     combined_data.index = combined_data.unix_time
 
-    # We can first merge the two with the same logging frequency    
+    # The stream with the same logging frequency is matched by time, 
+    # and the other data streams are projected onto the over-arching 
+    # datastream, all in one pass
     raw_data['ct2'].index = raw_data['ct2'].unix_time
 
-    combined_data = pd.merge_asof(
-        combined_data, 
-        raw_data['ct2'], 
-        left_index=True, 
-        right_index=True
-    )
+    combined_data = fusion.fuse(combined_data, [
+        fusion.AsofJoin(raw_data['ct2'], tolerance=max_asof_gap),
+        fusion.LinearJoin(raw_data['obs'].unix_time, raw_data['obs'].obs, 'obs_proj', max_interp_gap),
+        fusion.LinearJoin(raw_data['oos'].unix_time, raw_data['oos'].oxygen, 'oxygen_proj', max_interp_gap),
+    ])
 
-    # We can then project the data from the other data streams onto the 
-    # Over-arching datastream
-    interp_obs = interp1d(
-        raw_data['obs'].unix_time, 
-        raw_data['obs'].obs, 
-        fill_value='extrapolate'
-    )
 
-    interp_oos = interp1d(
-        raw_data['oos'].unix_time, 
-        raw_data['oos'].oxygen, 
-        fill_value='extrapolate'
-    )
+    combined_data['source'] = file_day
 
-    combined_data['obs_proj'] = interp_obs(combined_data['time(seconds since Jan 1 1970)'])
-    combined_data['oxygen_proj'] = interp_oos(combined_data['time(seconds since Jan 1 1970)'])
+    return combined_data
 
 
 
-    combined_data['source'] = file_day
+def aggregate_days(data_dir, days, workers=1, cache_dir=None, **gaps):
+    """Runs aggregate_data for each day, returning the results in day order.
+    
+    workers : with more than one worker, days are aggregated
+            in parallel in a pool of that many processes
+    cache_dir : optional directory for caching parsed sensor files
+    gaps : max_interp_gap and max_asof_gap, passed on to aggregate_data"""
+    if workers <= 1:
+        return [_run_day(day, aggregate_data, data_dir, day, cache_dir, **gaps) for day in days]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(aggregate_data, data_dir, day, cache_dir, **gaps) for day in days]
+        return [_run_day(day, future.result) for day, future in zip(days, futures)]
 
-    return combined_data
 
+def _run_day(day, func, *args, **kwargs):
+    # Makes it clear which day failed, 
+    # since the traceback alone won't say
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        raise RuntimeError(f"Failed to aggregate day {day}") from e
 
 
-def get_csv_and_navest(data_dir , clean_up = True):
-    days = get_file_names(data_dir)
+def get_renav_data(path):
+    """Parses a space separated renav file with date, time, 
+    lat, lon, depth, and four unused columns."""
+    # Every column stays a string here (along with the whole line, as 'lump')
+    return utils.load_from_file(path, 'RENAV')
+
+
+def get_days(data_dir):
     # We only take the files after the first because not
     # all datastreams seem to have been recording for that 
     # first day.
-    dfs = [aggregate_data(data_dir, day) for day in days[1:]]
+    return get_file_names(data_dir)[1:]
+
+
+def get_csv_and_navest(data_dir , clean_up = True, workers = 1, cache_dir = None, days = None, **gaps):
+    """Merges the sensor data for each day with the renav data.
+    
+    days : the days to include, defaults to every day from get_days
+    gaps : max_interp_gap and max_asof_gap, see aggregate_data"""
+    if days is None:
+        days = get_days(data_dir)
+    dfs = aggregate_days(data_dir, days, workers=workers, cache_dir=cache_dir, **gaps)
     combined = pd.concat(dfs, ignore_index=True)
 
 
 
     # Getting the renav data:
-    renav_file = f"{data_dir}/navest/J2-1393_renav.ppi"
-    renav_columns = ["date", "time", "lat", "lon", "depth", "ua", "ub", "uc", "ud"]
+    renav_file = f"{data_dir}/{RENAV_FILE}"
+    renav_data = cache.cached_load(cache_dir, get_renav_data, renav_file)
 
-    # The renav data is space seperated so we're just going to split each line
-    # to get the proper columns out.
-    renav_data = pd.read_csv(renav_file, header=None, names=['lump'])
-    renav_data[renav_columns] = renav_data.lump.str.split(' ').tolist()
+    return add_renav(combined, fusion.AsofJoin(renav_data, on='unix_time'), clean_up)
 
-    renav_data["unix_time"] = renav_data.apply(
-        lambda row: utils.date_time_to_unix(row['date'], row['time']), 
-        axis=1
-    ).tolist()
 
-    full_df = pd.merge_asof(combined, renav_data, left_on='unix_time_x', right_on='unix_time')
+def add_renav(combined, renav_join, clean_up=True):
+    """Joins the renav data (an AsofJoin) onto the aggregated days, 
+    and if clean_up, drops the unused columns and adds UTM coordinates"""
+    full_df = fusion.fuse(combined, [renav_join], on='unix_time_x')
 
     if clean_up:
         full_df.drop([
@@ -140,37 +160,19 @@ def get_csv_and_navest(data_dir , clean_up = True):
 
         # We will add a useful preprocessing step, by 
         # converting latlon into utm coords
-        full_df[['northing', 'easting']] = full_df.apply(
-            lambda row: utm.from_latlon(
-                row['lat'], 
-                row['lon']
-            )[:2], 
-            axis=1
-        ).tolist()
+        full_df['northing'], full_df['easting'] = utils.latlon_to_utm(
+            full_df.lat, 
+            full_df.lon
+        )
 
 
     return full_df
 
 
 def get_mass_spec(dir):
-    files = os.listdir(dir)
-    files.sort()
-
-    split_data = [pd.read_csv(os.path.join(dir, filename), header=None) for filename in files]
-
-    # The headers are stored as the first column of every file
-    # With a placeholder 0.0 at the top. So we are taking 
-    # Everything but the 0 in the first column of the first file
-    header = ['time'] + split_data[0][0][1:].tolist()
-
-    transposed_data = []
-    for data in split_data:
-        data = data.drop(columns=[0])
-        data = data.transpose()
-        data.columns = header
-        transposed_data.append(data)
-
-    return pd.concat(transposed_data, ignore_index=True)
+    """The mass spec data in wide format, with scott times (see mass_spec_utils.get_wide_data)"""
+    _, mass, block = mass_spec_utils.read_mass_spec_block(dir, unix=False)
+    return pd.DataFrame(block, columns=['time'] + mass.tolist(), copy=False)
 
 
 def get_methane_data(path, drop_duplicate=True):
@@ -182,8 +184,7 @@ def get_methane_data(path, drop_duplicate=True):
     We will drop duplicates by time, by default, drop_duplicate=False to disable
     
     """
-    data = pd.read_csv(path)
-    data['unix_time'] = data.timestamp.str.split(' ').apply(lambda x: utils.date_time_to_unix(x[0], x[1]))
+    data = utils.load_from_file(path, 'METHANE')
 
     if drop_duplicate:
         data = data.drop_duplicates('unix_time')
@@ -191,26 +192,244 @@ def get_methane_data(path, drop_duplicate=True):
     return data
 
 
+def combine(data_dir, methane_path, days=None, workers=1, cache_dir=None, **gaps):
+    """Runs the full pipeline, merging the sensor, renav, and methane data"""
+    data = get_csv_and_navest(data_dir, workers=workers, cache_dir=cache_dir, days=days, **gaps)
+    methane_data = cache.cached_load(cache_dir, get_methane_data, methane_path)
+
+    return fusion.fuse(data, [fusion.AsofJoin(methane_data, on='unix_time')], on='unix_time')
+
+
+def iter_methane_data(path, chunk_rows, drop_duplicate=True):
+    """get_methane_data in chunks of chunk_rows lines (the file must be in time order)"""
+    last_time = None
+    for data in utils.load_from_file(path, 'METHANE', chunksize=chunk_rows):
+        if drop_duplicate:
+            # Sorted, so a duplicate of the previous chunk can only be its last time
+            data = data.drop_duplicates('unix_time')
+            if last_time is not None:
+                data = data[data.unix_time.to_numpy() != last_time]
+            if len(data):
+                last_time = data.unix_time.iloc[-1]
+        yield data
+
+
+def combine_chunked(data_dir, methane_path, output_file, chunk_rows, days=None, 
+                    max_interp_gap=None, max_asof_gap=None):
+    """
+    Runs the full pipeline out of core, writing the same csv as combine.
+
+    Every input is read chunk_rows lines at a time, each chunk of the
+    navigation csv is joined with just the rows of the other streams 
+    around it (see fusion.StreamingAsofJoin), and the result is appended 
+    to output_file. Memory use depends on chunk_rows rather than the 
+    size of the dive. Every stream has to be in time order.
+    """
+    if days is None:
+        days = get_days(data_dir)
+
+    renav = fusion.StreamingAsofJoin(
+        utils.load_from_file(f"{data_dir}/{RENAV_FILE}", 'RENAV', chunksize=chunk_rows), 
+        on='unix_time'
+    )
+    methane = fusion.StreamingAsofJoin(iter_methane_data(methane_path, chunk_rows), on='unix_time')
+
+    first = True
+    for day in days:
+        file_paths = get_day_paths(data_dir, day)
+        ct2 = fusion.StreamingAsofJoin(
+            utils.load_from_file(file_paths['ct2'], chunksize=chunk_rows), 
+            on='unix_time', 
+            tolerance=max_asof_gap
+        )
+        obs = fusion.StreamingLinearJoin(
+            utils.load_from_file(file_paths['obs'], chunksize=chunk_rows), 
+            'unix_time', 'obs', 'obs_proj', max_interp_gap
+        )
+        oos = fusion.StreamingLinearJoin(
+            utils.load_from_file(file_paths['oos'], chunksize=chunk_rows), 
+            'unix_time', 'oxygen', 'oxygen_proj', max_interp_gap
+        )
+
+        for nav in utils.load_from_file(file_paths['csv'], chunksize=chunk_rows):
+            try:
+                nav.index = nav.unix_time
+                reference = nav.unix_time.to_numpy()
+                data = fusion.fuse(nav, [
+                    ct2.join_for(reference), 
+                    obs.join_for(reference), 
+                    oos.join_for(reference)
+                ])
+                data['source'] = day
+                data.index = pd.RangeIndex(len(data))
+
+                data = add_renav(data, renav.join_for(data.unix_time_x.to_numpy()))
+                data = fusion.fuse(data, [methane.join_for(data.unix_time.to_numpy())], on='unix_time')
+            except Exception as e:
+                raise RuntimeError(f"Failed to aggregate day {day}") from e
+
+            data.to_csv(output_file, mode='w' if first else 'a', header=first, index=False)
+            first = False
+
+
+def get_manifest(data_dir, methane_path, days):
+    """Fingerprints every input behind a combined output"""
+    return {
+        'version': cache.PARSER_VERSION,
+        'shared': {
+            'renav': cache.fingerprint(f"{data_dir}/{RENAV_FILE}"),
+            'methane': cache.fingerprint(methane_path),
+        },
+        'days': {
+            day: {ext: cache.fingerprint(path) for ext, path in get_day_paths(data_dir, day).items()}
+            for day 
+            in days
+        }
+    }
+
+
+def combine_incremental(data_dir, methane_path, output_file, output_format='csv', workers=1, cache_dir=None, **gaps):
+    """Brings output_file up to date, only reprocessing the days whose files 
+    are new or have changed since the manifest saved beside it was written.
+
+    Each day's sensor streams are only joined within that day, and rows 
+    are matched against renav and methane individually, so the rows of 
+    untouched days can't change unless the renav or methane files do. 
+    Those trigger a full rebuild. 
+    
+    Parquet outputs only rewrite the partitions of changed days. Csv outputs
+    keep the rows of untouched days exactly as written, and when only the last
+    days changed the file is cut off before them and appended to, without
+    reading it back."""
+    days = get_days(data_dir)
+    manifest = get_manifest(data_dir, methane_path, days)
+    manifest['format'] = output_format
+    manifest['gaps'] = {name: value for name, value in gaps.items() if value is not None}
+    manifest_path = output_file + MANIFEST_SUFFIX
+
+    previous = None
+    if os.path.exists(manifest_path) and os.path.exists(output_file):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+
+    if (
+        previous is None 
+        or previous['version'] != manifest['version']
+        or previous['shared'] != manifest['shared']
+        or previous.get('format', 'csv') != output_format
+        or previous.get('gaps', {}) != manifest['gaps']
+    ):
+        print("Rebuilding all days")
+        data = combine(data_dir, methane_path, days, workers=workers, cache_dir=cache_dir, **gaps)
+        dive_store.write_dataset(data, output_file, output_format)
+        _write_manifest(manifest, manifest_path)
+        return
+
+    changed = [day for day in days if previous['days'].get(day) != manifest['days'][day]]
+    removed = [day for day in previous['days'] if day not in manifest['days']]
+
+    if not changed and not removed:
+        print("Already up to date")
+        return
+
+    print(f"Reprocessing {len(changed)} days, removing {len(removed)} days")
+    # With only removed days there's nothing to aggregate
+    new_data = None
+    if changed:
+        new_data = combine(data_dir, methane_path, changed, workers=workers, cache_dir=cache_dir, **gaps)
+
+    if output_format == 'parquet':
+        dive_store.remove_partitions(output_file, changed + removed)
+        if new_data is not None:
+            dive_store.append_partitions(new_data, output_file)
+    elif min(changed + removed) > max(set(previous['days']) - set(changed + removed), default=''):
+        # Only the last days changed (as while a cruise is still being logged),
+        # so the rows before them stay exactly as they are
+        truncate_from_sources(output_file, changed + removed)
+        if new_data is not None:
+            new_data.to_csv(output_file, mode='a', header=False, index=False)
+    else:
+        # Read as text, so the rows of untouched days are written back unchanged
+        existing = pd.read_csv(output_file, dtype=str, keep_default_na=False)
+        existing = existing[~existing.source.isin(changed + removed)]
+
+        data = pd.concat([existing] + ([new_data] if new_data is not None else []), ignore_index=True)
+        # Keep the same day order as a full rebuild
+        day_order = pd.Categorical(data.source, categories=days, ordered=True)
+        data = data.iloc[day_order.argsort(kind='stable')]
+        data.to_csv(output_file, index=False)
+
+    _write_manifest(manifest, manifest_path)
+
+
+def truncate_from_sources(path, sources):
+    """Cuts a combined csv off at its first row from any of the source days, 
+    without parsing anything but the source column"""
+    source = pd.read_csv(path, usecols=['source'], dtype=str, keep_default_na=False).source
+    affected = np.flatnonzero(source.isin(sources).to_numpy())
+    if len(affected) == 0:
+        return
+
+    with open(path, 'r+b') as f:
+        # The header, then every row before the first affected one
+        for _ in range(affected[0] + 1):
+            f.readline()
+        f.truncate(f.tell())
+
+
+def _write_manifest(manifest, manifest_path):
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', required=True, type=str, help="Directory with J2-1393 sensor data")
     parser.add_argument('--methane_path', required=True, type=str, 
         help="Path to csv containing timestamp, fundamental, ringdown, and methane data")
 
-    parser.add_argument('--output_file', required=True, type=str, help="Where to save resulting csv")
+    parser.add_argument('--output_file', required=True, type=str, 
+        help="Where to save the resulting csv, or the directory for a parquet dataset")
+    parser.add_argument('--output_format', default='csv', choices=dive_store.OUTPUT_FORMATS, 
+        help="Either one csv file, or a parquet dataset partitioned by source day")
+    parser.add_argument('--workers', default=1, type=int, 
+        help="Number of processes used to aggregate days in parallel")
+    parser.add_argument('--cache_dir', default=None, type=str, 
+        help="Directory for caching parsed sensor files between runs")
+    parser.add_argument('--incremental', action='store_true', 
+        help="Only reprocess days that are new or changed since the last run with this output file")
+    parser.add_argument('--max_interp_gap', default=None, type=float, 
+        help="Leave OBS and oxygen missing rather than interpolate across gaps longer than this (seconds)")
+    parser.add_argument('--max_asof_gap', default=None, type=float, 
+        help="Leave CT2 readings missing when the latest is older than this (seconds)")
+    parser.add_argument('--chunk_rows', default=None, type=int, 
+        help="Process the dive out of core, this many lines of each input at a time (csv output only, "
+            "doesn't use --workers, --cache_dir or --incremental)")
 
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.chunk_rows is not None and (args.incremental or args.output_format != 'csv'):
+        parser.error("--chunk_rows only writes a whole csv, without --incremental")
+    return args
 
 
 
 if __name__ == '__main__':
     args = get_args()
-
-    data = get_csv_and_navest(args.data_dir)
-    methane_data = get_methane_data(args.methane_path)
-
-
-    data = pd.merge_asof(data, methane_data, left_on="unix_time", right_on="unix_time")
-    data.to_csv(args.output_file, index=False)
-
+    gaps = {'max_interp_gap': args.max_interp_gap, 'max_asof_gap': args.max_asof_gap}
+
+    if args.chunk_rows is not None:
+        combine_chunked(args.data_dir, args.methane_path, args.output_file, args.chunk_rows, **gaps)
+    elif args.incremental:
+        combine_incremental(
+            args.data_dir, 
+            args.methane_path, 
+            args.output_file, 
+            output_format=args.output_format,
+            workers=args.workers, 
+            cache_dir=args.cache_dir,
+            **gaps
+        )
+    else:
+        data = combine(args.data_dir, args.methane_path, workers=args.workers, cache_dir=args.cache_dir, **gaps)
+        dive_store.write_dataset(data, args.output_file, args.output_format)
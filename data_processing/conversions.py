@@ -0,0 +1,117 @@
+"""
+Time and coordinate conversions shared by the sensor parsers, the
+combining step and the plots.
+
+Nothing here imports the rest of data_processing, so any module
+(utils included) can import it without a cycle.
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+import utm
+
+
+def latlon_to_zone_numbers(lat, lon):
+    """Vectorized version of utm.latlon_to_zone_number, 
+    including the Norway and Svalbard exceptions."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    zones = ((lon + 180) / 6).astype(np.int64) % 60 + 1
+
+    norway = (56 <= lat) & (lat < 64) & (3 <= lon) & (lon < 12)
+    zones[norway] = 32
+
+    svalbard = (72 <= lat) & (lat <= 84) & (lon >= 0)
+    for upper, zone in reversed([(9, 31), (21, 33), (33, 35), (42, 37)]):
+        zones[svalbard & (lon < upper)] = zone
+
+    return zones
+
+
+def latlon_to_utm(lat, lon, split_zones=False):
+    """Projects arrays of latitude and longitude to utm in one pass,
+    returning numpy arrays in the same order as utm.from_latlon, (easting, northing).
+
+    The zone is selected once for the whole array. If the points fall 
+    in more than one zone a ValueError is raised, unless split_zones is
+    set, in which case every point is projected in its own zone."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    first = np.empty(lat.shape, dtype=np.float64)
+    second = np.empty(lat.shape, dtype=np.float64)
+    if lat.size == 0:
+        return first, second
+
+    zones = latlon_to_zone_numbers(lat, lon)
+    unique_zones = np.unique(zones)
+
+    if len(unique_zones) > 1 and not split_zones:
+        raise ValueError(f"Coordinates span multiple utm zones: {unique_zones.tolist()}")
+
+    for zone in unique_zones:
+        in_zone = zones == zone
+        first[in_zone], second[in_zone] = utm.from_latlon(
+            lat[in_zone], 
+            lon[in_zone], 
+            force_zone_number=int(zone)
+        )[:2]
+
+    return first, second
+
+
+def date_time_to_unix(date_str, time):
+    reformatted_date = '-'.join(date_str.split('/'))
+    d = datetime.date.fromisoformat(reformatted_date)
+    # Converts to unix UTC time
+    time_for_day = (d.toordinal() - datetime.date(1970, 1, 1).toordinal()) * 24*60*60
+    
+
+    time_piece = time.split(":")
+    time_of_day = datetime.timedelta(
+        hours = int(time_piece[0]),
+        minutes = int(time_piece[1]),
+        seconds = float(time_piece[2])
+    )
+    
+    return time_for_day + time_of_day.total_seconds()
+
+
+def dates_times_to_unix(dates, times):
+    """Vectorized version of date_time_to_unix. Accepts equal length
+    sequences (or Series) of date strings (YYYY/MM/DD or YYYY-MM-DD) and
+    time strings (HH:MM:SS.ffffff) and returns a float64 array of unix times.
+
+    The arithmetic mirrors date_time_to_unix (whole days in seconds plus
+    a time of day rounded to the microsecond) so the results are identical."""
+    dates = pd.Series(dates, copy=False).astype(str)
+    times = pd.Series(times, copy=False).astype(str)
+    if len(times) == 0:
+        # Such as a chunk of a file that's all comments
+        return np.empty(0, dtype=np.float64)
+
+    # A sensor file only spans a few distinct days, so
+    # we only parse each unique date once
+    codes, unique_dates = pd.factorize(dates)
+    unique_days = np.array(
+        [d.replace('/', '-') for d in unique_dates], 
+        dtype='datetime64[D]'
+    ).astype(np.int64)
+    day_seconds = unique_days[codes] * (24*60*60)
+
+    time_pieces = times.str.split(':', n=2, expand=True)
+    hours = time_pieces[0].astype(np.int64).to_numpy()
+    minutes = time_pieces[1].astype(np.int64).to_numpy()
+    seconds = time_pieces[2].astype(np.float64).to_numpy()
+
+    # timedelta keeps whole seconds exactly and rounds the 
+    # fractional part to the nearest microsecond (ties to even)
+    fraction, whole_seconds = np.modf(seconds)
+    microseconds = (
+        (hours*3600 + minutes*60 + whole_seconds.astype(np.int64)) * 1000000
+        + np.round(fraction * 1e6).astype(np.int64)
+    )
+
+    return day_seconds.astype(np.float64) + microseconds / 1e6
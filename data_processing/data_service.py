@@ -0,0 +1,114 @@
+"""
+Row lookups for the Dash apps.
+
+A DataService is built once from the points an app shows, and holds each
+column as a numpy array. A click is resolved to a row position once, and
+small things derived from that row (such as the json readout) are kept in
+an LRU cache keyed on the row's index label, so clicking back and forth
+between points only pays for drawing. The caches are bounded by entries,
+not size, so large values like image figures don't belong in them (rov_sim
+rebuilds camera figures from the frame server's cache, which is bounded by bytes).
+
+Nothing here changes after it's built except the caches, which are
+guarded by locks, so one service can be shared by the threads of a
+server. Under a multi-process server (such as gunicorn with several
+workers) each worker builds its own service when it imports the app.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LRUCache():
+    """A thread safe map holding the max_size most recently used entries"""
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """The value for key, calling compute() to make it if it isn't cached"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        # Computed outside the lock, so slow entries don't hold up other threads.
+        # Two threads may both compute the same entry, which is harmless
+        value = compute()
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _to_python(value):
+    # json can't serialize numpy integers and bools
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class DataService():
+    """
+    data : DataFrame of the points an app shows, indexed by the labels used as customdata
+    columns : the columns shown in readouts, defaults to all of them
+    cache_size : entries kept in each LRU cache
+    """
+    def __init__(self, data, columns=None, cache_size=256):
+        self.columns = list(columns) if columns is not None else list(data.columns)
+        self.arrays = {column: data[column].to_numpy() for column in data.columns}
+
+        labels = data.index.to_numpy()
+        self.order = np.argsort(labels, kind='stable')
+        self.sorted_labels = labels[self.order]
+
+        self.cache_size = cache_size
+        self.caches = {}
+        self.caches_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sorted_labels)
+
+    def position(self, label):
+        """Position of the row with index label, raises KeyError if there isn't one"""
+        found = np.searchsorted(self.sorted_labels, label)
+        if found == len(self.sorted_labels) or self.sorted_labels[found] != label:
+            raise KeyError(label)
+        return int(self.order[found])
+
+    def value(self, label, column):
+        return _to_python(self.arrays[column][self.position(label)])
+
+    def row(self, label):
+        """The readout columns of one row as a dict of plain python values"""
+        position = self.position(label)
+        return {column: _to_python(self.arrays[column][position]) for column in self.columns}
+
+    def cache(self, name):
+        """The named LRU cache, for anything else (small) derived from rows"""
+        with self.caches_lock:
+            if name not in self.caches:
+                self.caches[name] = LRUCache(self.cache_size)
+            return self.caches[name]
+
+    def cached(self, name, label, compute):
+        """compute(), cached under the row label in the named cache"""
+        return self.cache(name).get(label, compute)
+
+    def readout(self, label):
+        """The row as indented json, for the sensor display"""
+        return self.cached('readout', label, lambda: json.dumps(self.row(label), indent=2))
+
+
+def clicked_label(click_data):
+    """The customdata (row label) of the clicked point, or None"""
+    if not click_data or not click_data.get('points'):
+        return None
+    return click_data['points'][0].get('customdata')
@@ -0,0 +1,151 @@
+"""
+Picks which points to send to the browser for the current view.
+
+A full dive has far more points than a browser can draw smoothly, and
+far more than can be told apart on screen. Each function here returns
+positions of the points to keep:
+    - lttb and minmax thin a time series while keeping its shape
+      (largest triangle three buckets, or the extremes of each bucket)
+    - voxel keeps one point per occupied cell of a 3D grid, with the grid
+      made as fine as possible while staying within the point budget
+
+The apps recompute these whenever the timeline is zoomed (from its
+relayoutData), so zooming in shows more detail instead of the same points.
+"""
+import numpy as np
+
+# timeline_view's answer for relayout events that don't change the x axis (such as hovering modes)
+UNCHANGED = 'unchanged'
+
+# Points used to find the voxel grid size
+VOXEL_SAMPLE = 100000
+
+
+def lttb(x, y, max_points):
+    """Largest triangle three buckets: keeps the first and last points, and from
+    each bucket in between the point making the largest triangle with the
+    point kept before it and the average of the next bucket"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    count = len(x)
+    if count <= max_points or max_points < 3:
+        return np.arange(count) if count <= max_points else np.array([0, count - 1])
+
+    edges = np.linspace(1, count - 1, max_points - 1).astype(np.int64)
+    kept = np.empty(max_points, dtype=np.int64)
+    kept[0], kept[-1] = 0, count - 1
+
+    previous = 0
+    for bucket in range(max_points - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_start, next_stop = edges[bucket + 1], edges[bucket + 2]
+        else:
+            next_start, next_stop = count - 1, count
+        next_x = x[next_start:next_stop].mean()
+        next_y = y[next_start:next_stop].mean()
+
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:stop] - y[previous])
+            - (x[previous] - x[start:stop]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas)) if stop > start else start
+        kept[bucket + 1] = previous
+
+    return np.unique(kept)
+
+
+def minmax(x, y, max_points):
+    """Splits the series into max_points/2 equal sized buckets and keeps
+    the lowest and highest point of each, so no spike is ever dropped"""
+    count = len(x)
+    if count <= max_points:
+        return np.arange(count)
+
+    buckets = max(max_points // 2, 1)
+    bucket = np.arange(count) * buckets // count
+
+    # Sorting by value within each bucket puts each bucket's
+    # min first and max last (NaN values sort after the max)
+    y = np.asarray(y, dtype=np.float64)
+    order = np.lexsort((np.where(np.isnan(y), np.inf, y), bucket))
+    starts = np.searchsorted(bucket[order], np.arange(buckets), side='left')
+    stops = np.searchsorted(bucket[order], np.arange(buckets), side='right') - 1
+    return np.unique(np.concatenate([order[starts], order[stops]]))
+
+
+TIMELINE_METHODS = {'lttb': lttb, 'minmax': minmax}
+
+
+def _voxel_keys(coordinates, low, size, cells):
+    positions = np.clip(((coordinates - low) / size * cells).astype(np.int64), 0, cells - 1)
+    return (positions[:, 0] * cells + positions[:, 1]) * cells + positions[:, 2]
+
+
+def voxel(x, y, z, max_points):
+    """Keeps the first point in each occupied cell of the finest
+    cubic grid (over the points' bounding box) that occupies at most
+    max_points cells. Points with missing coordinates are dropped."""
+    coordinates = np.column_stack([x, y, z]).astype(np.float64)
+    finite = np.flatnonzero(np.isfinite(coordinates).all(axis=1))
+    if len(finite) <= max_points:
+        return finite
+
+    coordinates = coordinates[finite]
+    low = coordinates.min(axis=0)
+    size = np.maximum(coordinates.max(axis=0) - low, 1e-9)
+
+    def occupied(points, cells):
+        return len(np.unique(_voxel_keys(points, low, size, cells)))
+
+    # The number of occupied cells only grows with the grid, so the finest grid
+    # within budget is found by bisection, on a strided sample for large tracks
+    sample = coordinates[::max(len(coordinates) // VOXEL_SAMPLE, 1)]
+    most = 2
+    while occupied(sample, most) <= max_points and most < 2**20:
+        most *= 2
+    fewest = most // 2
+    while most - fewest > 1:
+        middle = (fewest + most) // 2
+        if occupied(sample, middle) <= max_points:
+            fewest = middle
+        else:
+            most = middle
+
+    # The full track can occupy cells the sample missed
+    while fewest > 1 and occupied(coordinates, fewest) > max_points:
+        fewest = max(int(fewest * 0.9), 1)
+
+    _, first = np.unique(_voxel_keys(coordinates, low, size, fewest), return_index=True)
+    return finite[np.sort(first)]
+
+
+def in_view(times, view):
+    """Positions of times inside view, a (start, end) pair, or all of them if view is None"""
+    times = np.asarray(times, dtype=np.float64)
+    if view is None:
+        return np.arange(len(times))
+    return np.flatnonzero((times >= view[0]) & (times <= view[1]))
+
+
+def timeline_view(relayout_data):
+    """The (start, end) x range of a zoomed timeline from its relayoutData,
+    None when the view is reset, or UNCHANGED when the event didn't touch the x axis"""
+    if not relayout_data or relayout_data.get('xaxis.autorange') or relayout_data.get('autosize'):
+        return None
+    if 'xaxis.range[0]' in relayout_data:
+        return (float(relayout_data['xaxis.range[0]']), float(relayout_data['xaxis.range[1]']))
+    if 'xaxis.range' in relayout_data:
+        start, end = relayout_data['xaxis.range']
+        return (float(start), float(end))
+    return UNCHANGED
+
+
+def discrete_colorscale(colors):
+    """A colorscale giving integer value n the solid color colors[n],
+    when used with cmin=-0.5 and cmax=len(colors) - 0.5"""
+    scale = []
+    for n, color in enumerate(colors):
+        scale.append([n / len(colors), color])
+        scale.append([(n + 1) / len(colors), color])
+    return scale
@@ -0,0 +1,218 @@
+"""
+Reading and writing the merged dive table produced by combine_data.py.
+
+The table is either a single csv, or a parquet dataset partitioned by
+source day. Readers can ask for a subset of columns and a unix_time
+window (plus any other simple column filters), which the parquet
+dataset applies while reading rather than after loading everything.
+"""
+import os
+import shutil
+import operator
+
+import numpy as np
+import pandas as pd
+
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+PARTITION_COLUMN = 'source'
+
+# Sensor readings don't have anywhere near double precision, so every
+# float column is stored as float32 except for times and positions,
+# where float32 would be off by minutes or meters
+FLOAT64_COLUMNS = [
+    'time(seconds since Jan 1 1970)', 'latitude(deg)', 'longitude(deg)',
+    'latitude origin(deg)', 'longitude origin(deg)', 'X UTM(m)', 'Y UTM(m)',
+    'lat', 'lon', 'northing', 'easting',
+]
+
+# The raw date and time strings (and whole renav lines) are only needed until
+# unix_time is worked out, and the renav file's last four fields are unused
+RAW_TIME_COLUMNS = ['date', 'date_x', 'date_y', 'time', 'time_x', 'time_y', 'timestamp', 'lump']
+UNUSED_COLUMNS = ['ua', 'ub', 'uc', 'ud']
+
+# String columns with at most this fraction of unique values become categoricals
+CATEGORY_FRACTION = .5
+
+FILTER_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+
+def get_format(path):
+    """Partitioned datasets are directories, anything else is read as csv"""
+    return 'parquet' if os.path.isdir(path) else 'csv'
+
+
+def keeps_float64(column):
+    return column in FLOAT64_COLUMNS or str(column).startswith('unix_time')
+
+
+def memory_usage(data):
+    """Bytes held by data, counting the contents of string columns"""
+    return int(data.memory_usage(index=True, deep=True).sum())
+
+
+def _dropped_columns(data, keep=None):
+    drop = list(UNUSED_COLUMNS)
+    if 'unix_time' in data.columns:
+        drop += RAW_TIME_COLUMNS
+    keep = set(keep or [])
+    return [column for column in drop if column in data.columns and column not in keep]
+
+
+def _float_type(column):
+    return np.float64 if keeps_float64(column) else np.float32
+
+
+def compact_schema(data, report=False, keep=None):
+    """
+    Shrinks the merged table to what the apps need:
+        - drops the raw time strings (once there's a unix_time) and the unused renav fields
+        - float32 for sensor readings, keeping float64 for times and positions
+        - the smallest integer type that holds each integer column
+        - categoricals for repeated strings (such as Vehicle and source)
+
+    The integer and categorical types depend on the values, so this is only
+    for tables in memory. Stored tables use storage_schema.
+
+    report : print the memory used before and after
+    keep : columns never dropped, even if they'd otherwise go
+    """
+    before = memory_usage(data) if report else None
+    data = data.drop(columns=_dropped_columns(data, keep))
+
+    types = {}
+    for column, dtype in data.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_float_dtype(dtype):
+            if dtype == np.float64 and not keeps_float64(column):
+                types[column] = np.float32
+        elif pd.api.types.is_integer_dtype(dtype):
+            smallest = pd.to_numeric(data[column], downcast='integer').dtype
+            if smallest != dtype:
+                types[column] = smallest
+        elif pd.api.types.is_string_dtype(dtype) or dtype == object:
+            if data[column].nunique() <= CATEGORY_FRACTION * len(data):
+                types[column] = 'category'
+
+    # The partition column is always a categorical of strings, however the source was read
+    if PARTITION_COLUMN in data.columns:
+        data[PARTITION_COLUMN] = data[PARTITION_COLUMN].astype(str)
+        types[PARTITION_COLUMN] = 'category'
+    data = data.astype(types)
+
+    if report:
+        after = memory_usage(data)
+        print(f"{len(data)} rows, {before/1e6:.2f} MB -> {after/1e6:.2f} MB ({after/max(before, 1):.0%})")
+    return data
+
+
+def storage_schema(data):
+    """
+    Gives every column a concrete type for storage that depends only on the
+    column, never on the values, so partitions appended on different runs
+    (or from different days) always share one schema:
+        - the same columns dropped as compact_schema
+        - float32 or float64 by column name, as compact_schema
+        - int64 for integers
+        - plain strings for everything else, including the partition column
+    """
+    data = data.drop(columns=_dropped_columns(data))
+
+    types = {}
+    for column, dtype in data.dtypes.items():
+        if pd.api.types.is_float_dtype(dtype):
+            types[column] = _float_type(column)
+        elif pd.api.types.is_bool_dtype(dtype):
+            continue
+        elif pd.api.types.is_integer_dtype(dtype):
+            types[column] = np.int64
+        else:
+            types[column] = 'string'
+    return data.astype(types)
+
+
+def write_dataset(data, path, output_format='csv'):
+    """Writes the merged table to path, replacing anything already there."""
+    if output_format == 'csv':
+        data.to_csv(path, index=False)
+        return
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    append_partitions(data, path)
+
+
+def append_partitions(data, path):
+    """Writes data into the parquet dataset at path,
+    adding to (rather than replacing) any existing partitions"""
+    storage_schema(data).to_parquet(
+        path,
+        partition_cols=[PARTITION_COLUMN],
+        index=False
+    )
+
+
+def remove_partitions(path, sources):
+    """Deletes the partitions of a parquet dataset for the given source days"""
+    for source in sources:
+        partition = os.path.join(path, f"{PARTITION_COLUMN}={source}")
+        if os.path.isdir(partition):
+            shutil.rmtree(partition)
+
+
+def get_filters(time_range=None, filters=None):
+    """Combines a (start, end) unix_time range (either end may be None)
+    with a list of (column, operator, value) filters"""
+    filters = list(filters or [])
+    if time_range is not None:
+        start, end = time_range
+        if start is not None:
+            filters.append(('unix_time', '>=', start))
+        if end is not None:
+            filters.append(('unix_time', '<=', end))
+    return filters
+
+
+def read_dataset(path, columns=None, time_range=None, filters=None, compact=True, report=False):
+    """
+    Loads the merged table from a csv file or a partitioned parquet dataset.
+
+    columns : only load these columns (filtered columns are loaded regardless)
+    time_range : (start, end) unix_time window to load, inclusive
+    filters : list of (column, operator, value), e.g. [('depth', '<', -1700)]
+    compact : shrink the table with compact_schema
+    report : print the memory used before and after compacting
+    """
+    filters = get_filters(time_range, filters)
+    filter_columns = [column for column, _, _ in filters]
+
+    read_columns = None
+    if columns is not None:
+        read_columns = list(columns) + [c for c in filter_columns if c not in columns]
+
+    if get_format(path) == 'parquet':
+        data = pd.read_parquet(path, columns=read_columns, filters=filters or None)
+    else:
+        data = pd.read_csv(path, usecols=read_columns)
+
+    # The parquet filters only skip what they can, so every
+    # filter is still applied row by row here
+    if filters:
+        mask = np.ones(len(data), dtype=bool)
+        for column, op, value in filters:
+            mask &= FILTER_OPERATORS[op](data[column], value).to_numpy()
+        data = data[mask].reset_index(drop=True)
+
+    if columns is not None:
+        data = data[list(columns)]
+    if compact:
+        data = compact_schema(data, report=report, keep=columns)
+    return data
@@ -0,0 +1,196 @@
+"""
+Retrieves decoded frames from a directory of video clips quickly.
+
+Seeking in compressed video means decoding forward from the previous
+keyframe, so the FrameServer avoids it wherever it can:
+    - a small pool of captures stays open (least recently used is closed)
+    - decoded frames are kept in a cache with a byte budget
+    - a request just after the current read position is reached by reading
+      forward, and only jumps past a keyframe (or backwards) seek
+    - a background thread decodes the next few frames after each request,
+      so stepping forward through a clip is served from the cache
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import video_catalog
+
+
+class _Capture():
+    """An open clip, along with where the next read will come from"""
+    def __init__(self, path):
+        self.cap = cv2.VideoCapture(path)
+        self.position = 0
+
+    def release(self):
+        self.cap.release()
+
+
+class FrameServer():
+    """
+    video_dir : directory of video clips
+    catalog_path : video catalog to read frame rates and keyframes from
+                (defaults to the catalog in video_dir, if there is one)
+    max_open : number of captures kept open at once
+    cache_bytes : budget for the decoded frame cache
+    prefetch : number of frames decoded ahead of each request
+    """
+    def __init__(self, video_dir, catalog_path=None, max_open=4, cache_bytes=512_000_000, prefetch=4):
+        self.video_dir = video_dir
+        self.max_open = max_open
+        self.cache_bytes = cache_bytes
+        self.prefetch = prefetch
+
+        self.captures = OrderedDict()
+        self.frames = OrderedDict()
+        self.frame_bytes = 0
+
+        # Captures aren't thread safe, everything touching
+        # them or the caches happens under this lock
+        self.lock = threading.RLock()
+
+        self.clip_info = self._load_clip_info(catalog_path)
+
+        self.prefetch_request = None
+        self.prefetch_ready = threading.Condition(self.lock)
+        if prefetch > 0:
+            threading.Thread(target=self._prefetch_loop, daemon=True).start()
+
+    def _load_clip_info(self, catalog_path):
+        # Read once up front, sqlite connections can't be shared between threads
+        catalog_path = catalog_path or os.path.join(self.video_dir, video_catalog.CATALOG_FILE)
+        if not os.path.exists(catalog_path):
+            return {}
+
+        catalog = video_catalog.VideoCatalog(self.video_dir, catalog_path)
+        clips = catalog.clips()
+        catalog.close()
+
+        clip_info = {}
+        for _, clip in clips[clips.error.isna()].iterrows():
+            keyframes = json.loads(clip.keyframes) if clip.keyframes else None
+            keyframe_indices = None
+            if keyframes is not None:
+                keyframe_indices = np.round(np.array(keyframes) * clip.fps).astype(np.int64)
+            clip_info[clip.filename] = (clip.fps, keyframe_indices)
+        return clip_info
+
+    def _capture(self, filename):
+        if filename in self.captures:
+            self.captures.move_to_end(filename)
+            return self.captures[filename]
+
+        capture = _Capture(os.path.join(self.video_dir, filename))
+        if not capture.cap.isOpened():
+            raise ValueError(f"Could not open {filename}")
+
+        self.captures[filename] = capture
+        if len(self.captures) > self.max_open:
+            _, oldest = self.captures.popitem(last=False)
+            oldest.release()
+        return capture
+
+    def fps(self, filename):
+        if filename not in self.clip_info:
+            fps = self._capture(filename).cap.get(cv2.CAP_PROP_FPS)
+            self.clip_info[filename] = (fps, None)
+        return self.clip_info[filename][0]
+
+    def frame_index(self, filename, seconds):
+        """The frame shown at the given number of seconds into a clip"""
+        return max(int(round(seconds * self.fps(filename))), 0)
+
+    def _should_seek(self, filename, position, index):
+        # A negative position means it's unknown (after a failed read)
+        if position < 0:
+            return True
+        if index < position:
+            return True
+
+        keyframes = self.clip_info.get(filename, (None, None))[1]
+        if keyframes is None:
+            # Without keyframe positions, read forward over short gaps only
+            return index - position > 2*self.fps(filename)
+
+        # Seeking decodes from the last keyframe before index. If that's
+        # no further along than where we are, reading forward is no worse
+        return np.any((keyframes > position) & (keyframes <= index))
+
+    def _cache(self, key, frame):
+        self.frames[key] = frame
+        self.frame_bytes += frame.nbytes
+        while self.frame_bytes > self.cache_bytes and len(self.frames) > 1:
+            _, evicted = self.frames.popitem(last=False)
+            self.frame_bytes -= evicted.nbytes
+
+    def _decode(self, filename, index):
+        key = (filename, index)
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            return self.frames[key]
+
+        capture = self._capture(filename)
+        if capture.position != index:
+            if self._should_seek(filename, capture.position, index):
+                capture.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+            else:
+                for _ in range(index - capture.position):
+                    capture.cap.grab()
+            capture.position = index
+
+        ret, frame = capture.cap.read()
+        if not ret:
+            # Where the read ended up is unknown, seek next time
+            capture.position = -1
+            raise ValueError("Image not found")
+        capture.position = index + 1
+
+        # CV2 orders the channels as bgr, this gives rgb
+        frame = np.ascontiguousarray(frame[:, :, ::-1])
+        self._cache(key, frame)
+        return frame
+
+    def get_frame(self, filename, seconds):
+        """The rgb frame seconds into the given clip"""
+        with self.lock:
+            index = self.frame_index(filename, seconds)
+            frame = self._decode(filename, index)
+
+            if self.prefetch > 0:
+                self.prefetch_request = (filename, index + 1, self.prefetch)
+                self.prefetch_ready.notify()
+            return frame
+
+    def _prefetch_loop(self):
+        while True:
+            with self.lock:
+                while self.prefetch_request is None:
+                    self.prefetch_ready.wait()
+
+                filename, index, remaining = self.prefetch_request
+                self.prefetch_request = (filename, index + 1, remaining - 1) if remaining > 1 else None
+                try:
+                    self._decode(filename, index)
+                except (ValueError, cv2.error):
+                    # Past the end of the clip, or an unreadable frame. Either
+                    # way the rest of this prefetch would fail too, and the
+                    # thread has to survive for the next one
+                    self.prefetch_request = None
+
+            # A newer request replaces whatever is left of this
+            # prefetch, so yield between frames to let it in
+            time.sleep(0)
+
+    def close(self):
+        with self.lock:
+            for capture in self.captures.values():
+                capture.release()
+            self.captures.clear()
+            self.frames.clear()
+            self.frame_bytes = 0
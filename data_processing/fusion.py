@@ -0,0 +1,275 @@
+"""
+Projects sensor streams logged at different rates onto one reference clock.
+
+Each stream is joined to the reference times in one of two ways:
+    - AsofJoin takes every column of the latest row at or before each
+      reference time (pd.merge_asof's default backward search)
+    - LinearJoin interpolates a single column linearly between the
+      readings either side of each reference time (scipy's interp1d,
+      extrapolating past either end)
+
+Either can refuse to match across gaps: an AsofJoin with a tolerance
+leaves rows missing when the latest reading is older than that, and a
+LinearJoin with a max_gap leaves them missing when the readings either
+side (or the nearest one, past the ends) are further apart than that.
+With neither set, the results match merge_asof and interp1d exactly.
+
+fuse runs every join against the whole reference in one pass and builds
+the output frame once at the end, so left and every stream are held in
+memory. To bound memory, stream the inputs instead (combine_data.combine_chunked).
+
+For inputs too large to hold at once, StreamingAsofJoin and
+StreamingLinearJoin read a stream in chunks as the reference clock moves
+forward, keeping only the rows needed to match the current reference
+chunk (plus the last readings before it). Joining chunk by chunk this way
+gives the same results as joining everything at once.
+"""
+import numpy as np
+import pandas as pd
+
+
+def _check_sorted(times, name):
+    if np.any(times[1:] < times[:-1]):
+        raise ValueError(f"{name} keys must be sorted")
+
+
+def asof_positions(reference, times, tolerance=None):
+    """The position in (sorted) times of the last entry at or
+    before each reference time, or -1 if there's none within tolerance"""
+    positions = np.searchsorted(times, reference, side='right') - 1
+    valid = positions >= 0
+    if tolerance is not None:
+        valid &= reference - times[np.clip(positions, 0, None)] <= tolerance
+    return np.where(valid, positions, -1)
+
+
+def interpolate(reference, times, values, max_gap=None):
+    """Linear interpolation of values (at sorted times) at each reference time,
+    extrapolating from the first or last two readings past either end.
+
+    This is the same arithmetic as interp1d(times, values, fill_value='extrapolate'),
+    so the results are identical. With max_gap, times whose bracketing readings
+    are more than max_gap apart (or more than max_gap past the ends) are NaN."""
+    if len(times) < 2:
+        # As interp1d, there's no line through fewer than two readings
+        raise ValueError(f"Interpolating needs at least two readings, got {len(times)}")
+
+    upper = np.clip(np.searchsorted(times, reference), 1, len(times) - 1)
+    lower = upper - 1
+
+    x_lo, x_hi = times[lower], times[upper]
+    y_lo, y_hi = values[lower], values[upper]
+
+    slope = (y_hi - y_lo) / (x_hi - x_lo)
+    projected = slope*(reference - x_lo) + y_lo
+
+    if max_gap is not None:
+        inside = (reference >= times[0]) & (reference <= times[-1])
+        past_ends = np.maximum(times[0] - reference, reference - times[-1])
+        too_far = np.where(inside, x_hi - x_lo, past_ends) > max_gap
+        projected = np.where(too_far, np.nan, projected)
+    return projected
+
+
+class AsofJoin():
+    """
+    Joins every column of data by the latest row at or before each reference time.
+
+    on : column holding data's times, or None to use its index
+    tolerance : furthest (in seconds) a row can be behind the reference time
+    """
+    def __init__(self, data, on=None, tolerance=None):
+        self.data = data
+        self.on = on
+        self.tolerance = tolerance
+        self.times = np.asarray(data.index if on is None else data[on], dtype=np.float64)
+        _check_sorted(self.times, 'right')
+
+    def positions(self, reference):
+        return asof_positions(reference, self.times, self.tolerance)
+
+    def columns(self, positions, left_on):
+        """The joined columns, taking rows at positions (missing where it's -1)"""
+        # A key with the same name on both sides is only kept once, from the left
+        skip = self.on if self.on is not None and self.on == left_on else None
+        return {
+            column: pd.api.extensions.take(self.data[column].array, positions, allow_fill=True)
+            for column
+            in self.data.columns
+            if column != skip
+        }
+
+
+class LinearJoin():
+    """
+    Joins one column, interpolated linearly at each reference time.
+
+    times, values : the readings, sorted by time
+    name : what to call the projected column
+    max_gap : furthest (in seconds) apart readings can be and still be interpolated between
+    """
+    def __init__(self, times, values, name, max_gap=None):
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+
+        # interp1d sorts the same way
+        if np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind='mergesort')
+            times, values = times[order], values[order]
+
+        if len(times) < 2:
+            raise ValueError(f"Can't interpolate {name} from {len(times)} readings, it needs at least two")
+
+        self.times = times
+        self.values = values
+        self.name = name
+        self.max_gap = max_gap
+
+    def project(self, reference):
+        return interpolate(reference, self.times, self.values, self.max_gap)
+
+
+def _suffixed(columns, joined, suffixes):
+    # Names that collide get suffixed on both sides, as pd.merge does
+    overlap = set(columns) & set(joined)
+    left = {column: column + suffixes[0] if column in overlap else column for column in columns}
+    right = {column: column + suffixes[1] if column in overlap else column for column in joined}
+    return left, right
+
+
+def fuse(left, joins, on=None, suffixes=('_x', '_y')):
+    """
+    Joins every stream in joins onto the rows of left in one pass,
+    returning a new frame with left's columns followed by each join's,
+    named as the equivalent chain of pd.merge_asof calls would name them.
+
+    Everything (left, the streams and the output) is held in memory. For
+    bounded memory, call fuse on chunks of left with StreamingAsofJoin and
+    StreamingLinearJoin providing the joins, as combine_data.combine_chunked does.
+
+    on : column of left to use as the reference clock, or None to use its index
+    """
+    reference = np.asarray(left.index if on is None else left[on], dtype=np.float64)
+    if any(isinstance(join, AsofJoin) for join in joins):
+        _check_sorted(reference, 'left')
+
+    columns = {column: left[column].array for column in left.columns}
+    for join in joins:
+        if isinstance(join, AsofJoin):
+            joined = join.columns(join.positions(reference).astype(np.int64), on)
+        else:
+            joined = {join.name: join.project(reference)}
+
+        left_names, right_names = _suffixed(columns, joined, suffixes)
+        columns = {
+            **{left_names[column]: values for column, values in columns.items()},
+            **{right_names[column]: values for column, values in joined.items()},
+        }
+
+    return pd.DataFrame(columns, index=left.index)
+
+
+def _concat(chunks):
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+
+class StreamingAsofJoin():
+    """
+    An AsofJoin over a stream of time sorted DataFrame chunks,
+    such as the chunks of utils.load_from_file with a chunksize.
+
+    on, tolerance : see AsofJoin (on is required, chunk indexes aren't kept)
+    """
+    def __init__(self, chunks, on, tolerance=None):
+        self.chunks = iter(chunks)
+        self.on = on
+        self.tolerance = tolerance
+        self.buffer = None
+        self.exhausted = False
+
+    def _times(self):
+        return np.asarray(self.buffer[self.on], dtype=np.float64)
+
+    def _fill(self, until):
+        # Reads until a row is past until (or the stream runs out),
+        # so every row at or before it has been seen
+        pending = [self.buffer] if self.buffer is not None else []
+        last = self._times()[-1] if self.buffer is not None and len(self.buffer) else -np.inf
+        while not self.exhausted and last <= until:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.exhausted = True
+            elif len(chunk):
+                pending.append(chunk)
+                last = float(chunk[self.on].iloc[-1])
+        if pending:
+            self.buffer = _concat(pending)
+
+    def join_for(self, reference):
+        """An AsofJoin for the (sorted) reference times, which must not go
+        back before the previous call's. Older rows are dropped."""
+        reference = np.asarray(reference, dtype=np.float64)
+        if len(reference):
+            self._fill(reference[-1])
+        if self.buffer is None:
+            raise ValueError(f"No data in the stream joined on {self.on}")
+
+        # Only the last row at or before the first reference time is still needed
+        if len(reference) and len(self.buffer):
+            start = max(np.searchsorted(self._times(), reference[0], side='right') - 1, 0)
+            self.buffer = self.buffer.iloc[start:].reset_index(drop=True)
+        return AsofJoin(self.buffer, on=self.on, tolerance=self.tolerance)
+
+
+class StreamingLinearJoin():
+    """
+    A LinearJoin over a stream of time sorted DataFrame chunks.
+
+    time_column, value_column : columns of each chunk holding the readings
+    name, max_gap : see LinearJoin
+    """
+    def __init__(self, chunks, time_column, value_column, name, max_gap=None):
+        self.chunks = iter(chunks)
+        self.time_column = time_column
+        self.value_column = value_column
+        self.name = name
+        self.max_gap = max_gap
+        self.times = np.empty(0, dtype=np.float64)
+        self.values = np.empty(0, dtype=np.float64)
+        self.exhausted = False
+
+    def _fill(self, until):
+        # Reads until a reading is past until (or the stream runs out), so each
+        # reference time has the readings either side of it, and there are always
+        # at least the two readings needed to extrapolate
+        times, values = [self.times], [self.values]
+        last = self.times[-1] if len(self.times) else -np.inf
+        count = len(self.times)
+        while not self.exhausted and (last <= until or count < 2):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.exhausted = True
+            elif len(chunk):
+                times.append(np.asarray(chunk[self.time_column], dtype=np.float64))
+                values.append(np.asarray(chunk[self.value_column], dtype=np.float64))
+                last = times[-1][-1]
+                count += len(chunk)
+        self.times = np.concatenate(times)
+        self.values = np.concatenate(values)
+
+    def join_for(self, reference):
+        """A LinearJoin for the (sorted) reference times, which must not go
+        back before the previous call's. Older readings are dropped."""
+        reference = np.asarray(reference, dtype=np.float64)
+        # Even with no reference times, LinearJoin needs its two readings
+        self._fill(reference[-1] if len(reference) else -np.inf)
+
+        # Unlike LinearJoin the readings can't be sorted first, as they're never all here
+        _check_sorted(self.times, self.name)
+
+        # The two readings before the first reference time are kept, which covers
+        # both interpolating from the one before and extrapolating past the end
+        if len(reference):
+            start = max(np.searchsorted(self.times, reference[0]) - 2, 0)
+            self.times, self.values = self.times[start:], self.values[start:]
+        return LinearJoin(self.times, self.values, self.name, self.max_gap)
@@ -1,10 +1,3 @@
-import cv2
-import matplotlib.pyplot as plt
-import sys
-import pandas as pd
-import os
-import numpy as np
-import json
 import argparse
 
 import plotly.graph_objects as go
@@ -13,78 +6,54 @@ import plotly.express as px
 from dash import Dash
 from dash import html, dcc
 from dash.dependencies import Input, Output
+from dash.exceptions import PreventUpdate
 
 # Custom files
-import video_extraction
-import combine_data
+import video_catalog
 import utils
+import cache
+import dive_store
 import mass_spec_utils 
+import decimation
+import data_service
 
 
 
-def get_frames(video_dir):
+def get_frames(video_dir, catalog_path=None):
     """get_frames takes in a directory of video files
     to read in, and returns a map from the name of the file
     to a tuple of the start time and end time in unix.
     This is used to later figure out which file a given 
-    timepoint is associated with (if any)"""
-
-    start_end_by_file = {}
-
-    for filename in os.listdir(video_dir):
-        if filename.startswith('.'):
-            continue
-            
-        path = os.path.join(video_dir, filename)
-        
-        starttime = video_extraction.get_start_time(path)
-        
-        cap = cv2.VideoCapture(path)
-        
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        duration = frame_count/fps
-
-        approx_endtime = starttime + duration
-        
-        start_end_by_file[filename] = (starttime, approx_endtime)
+    timepoint is associated with (if any)
+    
+    Clip metadata comes from the video catalog, which is 
+    brought up to date first (only new or changed clips are probed)."""
+    catalog = video_catalog.VideoCatalog(video_dir, catalog_path)
+    catalog.update()
+    start_end_by_file = catalog.start_end_by_file()
+    catalog.close()
 
     return start_end_by_file
 
 
-def time_to_file(time, start_end_by_file, return_int=False):
-    """Given a time, and a map from file to 
-    start and end time, return which file
-    time belongs in. (None if none)"""
-    index = 0
-    for file, (start, end) in start_end_by_file.items():
-        index += 1
-        if start <= time and time <= end:
-            if return_int:
-                return index
-            return file
-    return None
-
-
-def run_server(fig, timeline, near_vent, mass_spec):
-    """run_server handles the dash server interaction.
+def create_app(make_figures, service, spectra, default_window=10):
+    """create_app builds the dash app.
     It set's up the html pattern, and defines the handler functions
-    for user interaction. Finally, it calls the dash run function,
-    starting the server.
+    for user interaction.
     
     Args:
-        fig: a figure to display related to the data. 
-            used here as a spatial element.
-
-        timeline: A time series of the data, used to select
-            points of interest to display other data
+        make_figures: gives a spatial figure and a timeline (used
+            to select points of interest to display other data) for a 
+            unix time range of the timeline, or None for all of it.
+            Called again whenever the timeline is zoomed.
             
-        near_vent: the underlying data of interest, 
-            used for displaying sensor readouts.
+        service: a data_service.DataService of the underlying 
+            data of interest, used for displaying sensor readouts.
             
-        mass_spec: wide mass spec data with each row 
-            representing a point in time, with readings for 
-            each mass."""
+        spectra: a mass_spec_utils.SpectrumServer, giving the
+            spectrum figure for the scans at or around a time."""
+
+    fig, timeline = make_figures()
 
     app = Dash(__name__)
 
@@ -111,7 +80,17 @@ def run_server(fig, timeline, near_vent, mass_spec):
     app.layout = html.Div(children=[
 
         html.Div(children = [
-            dcc.Graph(id = "mass_spec"),
+            html.Div(children = [
+                dcc.Graph(id = "mass_spec"),
+                dcc.RadioItems(
+                    id = 'spectrum_mode',
+                    options = [{'label': mode, 'value': mode} for mode in mass_spec_utils.SpectrumServer.MODES],
+                    value = 'nearest',
+                    inline = True
+                ),
+                'Window (s): ',
+                dcc.Input(id = 'spectrum_window', type = 'number', value = default_window, min = 0),
+            ]),
            
             html.Pre(id='sensor_display', style = styles['pre'])
         ], style = styles['display_wrapper']),
@@ -127,33 +106,41 @@ def run_server(fig, timeline, near_vent, mass_spec):
         
     # SCRIPTING
     @app.callback(
-        Output(component_id = 'mass_spec', component_property='figure'),
-        Input('timeline', 'clickData')
+        Output(component_id = 'spatial', component_property='figure'),
+        Output(component_id = 'timeline', component_property='figure'),
+        Input('timeline', 'relayoutData'),
+        prevent_initial_call=True
     )
-    def set_mass_spec(node_clicked):
-        # Get time of point
-        custom_data = node_clicked['points'][0]['customdata']
-        timestamp = data.loc[custom_data]['unix_time']
-
-        row = utils.get_row_by_value(mass_spec, "time", timestamp)
-        row_time = row[0]
-
-        time_diff = abs(timestamp - row_time)
+    def set_view(relayout_data):
+        view = decimation.timeline_view(relayout_data)
+        if view is decimation.UNCHANGED:
+            raise PreventUpdate
+        return make_figures(view)
 
-        return px.line( x = row.index[1:], y = row[1:].tolist(), )
-        
-        
     @app.callback(
+        Output(component_id = 'mass_spec', component_property='figure'),
         Output(component_id = 'sensor_display', component_property='children'),
-        Input('timeline', 'clickData')
+        Input('timeline', 'clickData'),
+        Input('spectrum_mode', 'value'),
+        Input('spectrum_window', 'value')
     )
-    def set_sensor_readout(node_clicked):
-        node_index = node_clicked['points'][0]['customdata']
-        data = near_vent.loc[node_index].to_dict()
-        print(data)
-        return json.dumps(data, indent=2)
-    
+    def set_selection(node_clicked, mode, window):
+        # Everything shown for a click comes from the one row lookup
+        label = data_service.clicked_label(node_clicked)
+        if label is None:
+            raise PreventUpdate
+
+        figure = spectra.figure(service.value(label, 'unix_time'), mode, window)
+        return figure, service.readout(label)
+
+    return app
 
+
+def run_server(make_figures, near_vent, spectra, default_window=10):
+    """run_server starts the dash server, with the readouts
+    served from a data_service.DataService of near_vent"""
+    service = data_service.DataService(near_vent)
+    app = create_app(make_figures, service, spectra, default_window)
     app.run(port="8002", debug=True)
 
 
@@ -164,7 +151,7 @@ def get_args():
         "--data_file", 
         required=True,
         type=str, 
-        help="Expects a labeled csv file with at least columns labeled 'unix_time', 'northing', 'easting'"
+        help="Expects a labeled csv file (or partitioned parquet dataset) with at least columns labeled 'unix_time', 'northing', 'easting'"
     )
     parser.add_argument(
         "--mesh_file",
@@ -172,11 +159,29 @@ def get_args():
         type=str,
         help="An unlabeled tsv file with column 1 latitude column 2 longitude and column 3 depth"
     )
+    parser.add_argument(
+        "--mesh_vertices",
+        default=20000,
+        type=int,
+        help="Vertex budget for the bathymetry mesh, picks the finest level of detail that fits"
+    )
     parser.add_argument(
         "--mass_spec_dir",
         required=True,
         type=str,
-        help="The directory storing mass spectrometry csv files."
+        help="The directory storing mass spectrometry csv files, or a store built by mass_spec_utils.py --build_store"
+    )
+    parser.add_argument(
+        "--max_scan_gap",
+        default=None,
+        type=float,
+        help="Furthest (in seconds) a scan can be from a clicked point and still be shown"
+    )
+    parser.add_argument(
+        "--spectrum_window",
+        default=10,
+        type=float,
+        help="Default window (in seconds) for averaging or overlaying scans around a clicked point"
     )
     parser.add_argument(
         '--subsample_factor',
@@ -185,6 +190,36 @@ def get_args():
         help="The factor by which to subsample data. (E.g. if factor is 5, 1/5 of points are taken)"
 
     )
+    parser.add_argument(
+        "--max_points",
+        default=5000,
+        type=int,
+        help="Most points to draw in each of the track and timeline, they're decimated to fit the current view"
+    )
+    parser.add_argument(
+        "--timeline_method",
+        default='minmax',
+        choices=sorted(decimation.TIMELINE_METHODS),
+        help="How the timeline is decimated"
+    )
+    parser.add_argument(
+        "--start_time",
+        default=None,
+        type=float,
+        help="Only load data from this unix time onwards"
+    )
+    parser.add_argument(
+        "--end_time",
+        default=None,
+        type=float,
+        help="Only load data up to this unix time"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        type=str,
+        help="Directory for caching parsed input files between runs"
+    )
 
     args = parser.parse_args()
     return args
@@ -195,12 +230,25 @@ if __name__ == '__main__':
 
     args = get_args()
 
-    data = pd.read_csv(args.data_file)
+    # TODO: This is specific to ring vent
+    data = cache.cached_load(
+        args.cache_dir, 
+        dive_store.read_dataset, 
+        args.data_file, 
+        time_range=(args.start_time, args.end_time), 
+        filters=[('depth', '<', -1700)],
+        report=True
+    )
 
-    mass_spec = mass_spec_utils.get_wide_data(args.mass_spec_dir)            
+    if mass_spec_utils.is_mass_spec_store(args.mass_spec_dir):
+        mass_spec = mass_spec_utils.MassSpecStore.open(args.mass_spec_dir)
+    else:
+        mass_spec = mass_spec_utils.MassSpecStore.from_wide(
+            cache.cached_load(args.cache_dir, mass_spec_utils.get_wide_data, args.mass_spec_dir)
+        )
 
     # Get Mesh
-    mesh = utils.get_mesh(args.mesh_file, 1000)
+    mesh = utils.get_mesh(args.mesh_file, max_vertices=args.mesh_vertices, cache_dir=args.cache_dir)
     mesh.opacity = .3
     mesh.hoverinfo = "skip"
 
@@ -213,33 +261,49 @@ if __name__ == '__main__':
     near_vent = near_vent[near_vent.index % args.subsample_factor == 0]
 
     
-    scatterplot = go.Scatter3d(
-        x=near_vent.northing,
-        y=near_vent.easting,
-        z=near_vent.depth,
-        text = near_vent.unix_time,
-        mode='markers',
-        marker=dict(
-            color=near_vent.rgb,
-        ),
-        customdata = near_vent.index
-    )
-
-    PLOT_MESH = True
-    fig = go.Figure(data = ([mesh, scatterplot] if PLOT_MESH else [scatterplot]))
-
-    timeline_plot = go.Scatter(
-        x=near_vent.unix_time,
-        y=[0]*len(near_vent),
-        text = near_vent.unix_time,
-        mode='markers',
-        marker=dict(
-            color=near_vent.rgb,
-        ),
-        customdata = near_vent.index
-    )
-    timeline = go.Figure(data=[timeline_plot])
-    
-
-
-    run_server(fig, timeline, near_vent, mass_spec)
\ No newline at end of file
+    def make_figures(view=None):
+        """The spatial and timeline figures for the points in view (a unix time
+        range, or everything), decimated to at most args.max_points each"""
+        in_view = decimation.in_view(near_vent.unix_time, view)
+        points = near_vent.iloc[in_view]
+
+        track_points = points.iloc[decimation.voxel(points.northing, points.easting, points.depth, args.max_points)]
+        scatterplot = go.Scatter3d(
+            x=track_points.northing,
+            y=track_points.easting,
+            z=track_points.depth,
+            text = track_points.unix_time,
+            mode='markers',
+            marker=dict(
+                color=track_points.rgb.to_numpy(),
+            ),
+            customdata = track_points.index
+        )
+
+        PLOT_MESH = True
+        fig = go.Figure(data = ([mesh, scatterplot] if PLOT_MESH else [scatterplot]))
+        fig.update_layout(uirevision='spatial')
+
+        # Thinned on depth and drawn against it, so the timeline shows the ups and downs of the dive
+        method = decimation.TIMELINE_METHODS[args.timeline_method]
+        timeline_points = points.iloc[method(points.unix_time, points.depth, args.max_points)]
+        timeline_plot = go.Scattergl(
+            x=timeline_points.unix_time,
+            y=timeline_points.depth,
+            text = timeline_points.unix_time,
+            mode='markers',
+            marker=dict(
+                color=timeline_points.rgb.to_numpy(),
+            ),
+            customdata = timeline_points.index
+        )
+        timeline = go.Figure(data=[timeline_plot])
+        timeline.update_layout(uirevision='timeline', yaxis_title='depth')
+        if view is not None:
+            timeline.update_xaxes(range=list(view))
+
+        return fig, timeline
+
+
+    spectra = mass_spec_utils.SpectrumServer(mass_spec, max_gap=args.max_scan_gap)
+    run_server(make_figures, near_vent, spectra, args.spectrum_window)
@@ -1,9 +1,10 @@
-import utils
+from time_index import TimeIndex
+import data_service
 import os
 import argparse
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import plotly.express as px
 
 
 def scott_time_to_unix(scott_time):
@@ -18,58 +19,309 @@ def get_long_data(data_dir):
     """get_long_data parses the mass spec data into 
     a 'long' format, where the columns are time, mass_spec, and mass.
     In other words, each row is a reading of a particular mass at a particular time"""
-    files = os.listdir(data_dir)
-    files.sort()
-
-    split_data = [pd.read_csv(os.path.join(data_dir, filename)) for filename in files]
-
-
-    long_split = []
-    for data in split_data:
-        data = data.melt(id_vars=data.columns[0], var_name='time', value_name='mass_spec')
-        data['mass'] = data[data.columns[0]]
-        data = data.drop(columns=data.columns[0])
-        long_split.append(data)
-
-    long_data = pd.concat(long_split, ignore_index=True)
+    header_times, mass, block = read_mass_spec_block(data_dir)
+    scans = len(block)
 
-
-    long_data['time'] = long_data['time'].astype('float64')
-    long_data['time'] = long_data.time.apply(scott_time_to_unix)
-    return long_data
+    # Scan by scan, with every mass for each scan
+    return pd.DataFrame({
+        'time': np.repeat(scott_time_to_unix(header_times), len(mass)),
+        'mass_spec': block[:, 1:].ravel(),
+        'mass': np.tile(whole_masses(mass), scans),
+    })
 
 def get_wide_data(data_dir):
     """get_wide_data parses mass spec data into 
     a wide format. There are columns for time, and each of the masses 
     measured by the mass spectrometry. Each row is a reading across all 
     masses at a specific time."""
-    files = os.listdir(data_dir)
+    _, mass, block = read_mass_spec_block(data_dir)
+
+    # The block already has the time column first, so this is a view of it
+    return pd.DataFrame(block, columns=['time'] + mass.tolist(), copy=False)
+
+
+def read_mass_spec_block(data_dir, unix=True):
+    """Reads every mass spec csv in data_dir into one (scans x (1 + masses)) 
+    float64 array, with the scan time in the first column and a reading for 
+    each mass in the rest, in file order. Only one file is held in memory 
+    besides the block.
+
+    Returns the scan times as read from the header lines, the masses, and the block.
+    The header times are parsed exactly, while the block holds the times as the 
+    csv reader parses them (get_long_data and get_wide_data have always used one 
+    and the other), so the two can differ in the last bit.
+
+    unix : convert times from scott time to unix time"""
+    paths = get_mass_spec_files(data_dir)
+
+    # The header lines give the number of scans up front
+    header_times = np.concatenate([read_scan_times(path) for path in paths])
+
+    block = None
+    mass = None
+    offset = 0
+    for path in paths:
+        times, file_mass, readings = read_mass_spec_file(path)
+
+        if block is None:
+            mass = file_mass
+            block = np.empty((len(header_times), len(mass) + 1), dtype=np.float64)
+        elif not np.array_equal(file_mass, mass):
+            raise ValueError(f"{path} measures different masses than {paths[0]}")
+
+        block[offset:offset + len(times), 0] = times
+        block[offset:offset + len(times), 1:] = readings
+        offset += len(times)
+
+    if block is None:
+        raise ValueError(f"No mass spec files in {data_dir}")
+
+    if unix:
+        block[:, 0] = scott_time_to_unix(block[:, 0])
+    return header_times, mass, block
+
+
+
+# The files making up a mass spec store
+STORE_FILES = {
+    'time': 'time.npy',
+    'mass': 'mass.npy',
+    'intensity': 'intensity.npy',
+}
+
+
+def get_mass_spec_files(data_dir):
+    files = [filename for filename in os.listdir(data_dir) if not filename.startswith('.')]
     files.sort()
+    return [os.path.join(data_dir, filename) for filename in files]
 
-    split_data = [pd.read_csv(os.path.join(data_dir, filename), header=None) for filename in files]
-    # The headers are stored as the first column of every file
-    # With a placeholder 0.0 at the top. So we are taking 
-    # Everything but the 0 in the first column of the first file
-    header = ['time'] + split_data[0][0][1:].tolist()
-
-    transposed_data = []
-    for data in split_data:
-        data = data.drop(columns=[0])
-        data = data.transpose()
-        data.columns = header
-        transposed_data.append(data)
-
-    combined = pd.concat(transposed_data, ignore_index=True)
-    combined['time'] = combined.time.apply(scott_time_to_unix)
-    
-    return combined
 
+def read_mass_spec_file(path):
+    """Reads a single mass spec csv, returning the scott times of its scans,
+    the masses measured, and a (scans x masses) array of readings"""
+    values = pd.read_csv(path, header=None, dtype=np.float64).to_numpy()
+    return values[0, 1:], values[1:, 0], values[1:, 1:].T
+
+
+def whole_masses(mass):
+    """The masses as int64 when they're all whole numbers, as get_long_data has always given them"""
+    if len(mass) and np.all(np.isfinite(mass)) and np.all(mass == np.round(mass)):
+        return mass.astype(np.int64)
+    return mass
+
+
+def read_scan_times(path):
+    """Reads just the header line of a mass spec csv, the scott time of each scan"""
+    with open(path) as f:
+        header = f.readline()
+    return np.array(header.split(',')[1:], dtype=np.float64)
+
+
+def build_mass_spec_store(data_dir, store_dir):
+    """Converts a directory of mass spec csvs into a store of numpy files:
+    a time vector (unix, sorted), a mass axis, and a (scans x masses) 
+    intensity matrix that can be memory mapped. Only one csv is held 
+    in memory at a time."""
+    paths = get_mass_spec_files(data_dir)
+    if not paths:
+        raise ValueError(f"No mass spec files in {data_dir}")
+
+    # The header lines give every scan time up front, so
+    # each file's rows can be written straight to their sorted position
+    times = scott_time_to_unix(np.concatenate([read_scan_times(path) for path in paths]))
+    order = np.argsort(times, kind='stable')
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order))
+
+    os.makedirs(store_dir, exist_ok=True)
+    intensity = None
+    mass = None
+    offset = 0
+
+    for path in paths:
+        _, file_mass, readings = read_mass_spec_file(path)
+
+        if intensity is None:
+            mass = file_mass
+            intensity = np.lib.format.open_memmap(
+                os.path.join(store_dir, STORE_FILES['intensity']),
+                mode='w+',
+                dtype=np.float64,
+                shape=(len(times), len(mass))
+            )
+        elif not np.array_equal(file_mass, mass):
+            raise ValueError(f"{path} measures different masses than {paths[0]}")
+
+        intensity[position[offset:offset + len(readings)]] = readings
+        offset += len(readings)
+
+    if intensity is None:
+        raise ValueError(f"No mass spec files in {data_dir}")
+    intensity.flush()
+    np.save(os.path.join(store_dir, STORE_FILES['time']), times[order])
+    np.save(os.path.join(store_dir, STORE_FILES['mass']), mass)
+
+
+def is_mass_spec_store(path):
+    return os.path.exists(os.path.join(path, STORE_FILES['intensity']))
+
+
+class MassSpecStore():
+    """
+    Wide mass spec data held as a sorted time vector, a mass axis, 
+    and a (scans x masses) matrix of intensities. When opened from 
+    disk the matrix is memory mapped, so only the rows used are read.
+    """
+    def __init__(self, time, mass, intensity):
+        self.time = time
+        self.mass = mass
+        self.intensity = intensity
+        self.time_index = TimeIndex(time, assume_sorted=True)
+
+    @classmethod
+    def open(cls, store_dir):
+        return cls(
+            np.load(os.path.join(store_dir, STORE_FILES['time'])),
+            np.load(os.path.join(store_dir, STORE_FILES['mass'])),
+            np.load(os.path.join(store_dir, STORE_FILES['intensity']), mmap_mode='r')
+        )
+
+    @classmethod
+    def from_wide(cls, wide_data):
+        """Builds an in memory store from get_wide_data's output"""
+        time = wide_data['time'].to_numpy(dtype=np.float64)
+        order = np.argsort(time, kind='stable')
+        intensity = wide_data.iloc[:, 1:].to_numpy(dtype=np.float64)
+        mass = np.asarray(wide_data.columns[1:], dtype=np.float64)
+        return cls(time[order], mass, intensity[order])
+
+    def __len__(self):
+        return len(self.time)
+
+    def row(self, index):
+        """The readings across every mass for one scan"""
+        return self.intensity[index]
+
+    def window(self, start, end):
+        """The times and readings of the scans between start and end (inclusive),
+        as views that are only read when used"""
+        lo = np.searchsorted(self.time, start, side='left')
+        hi = np.searchsorted(self.time, end, side='right')
+        return self.time[lo:hi], self.intensity[lo:hi]
+
+    def nearest(self, timestamp, max_gap=None):
+        """The scan closest to timestamp, or -1 if there isn't one within max_gap seconds"""
+        return self.time_index.nearest(timestamp, tolerance=max_gap)
+
+    def to_wide(self):
+        """The same layout as get_wide_data, but sorted by time"""
+        wide = pd.DataFrame(np.asarray(self.intensity), columns=self.mass.tolist())
+        wide.insert(0, 'time', self.time)
+        return wide
+
+
+class SpectrumServer():
+    """
+    Spectrum figures for the scans nearest to (or around) a time.
+
+    Figures are plain dicts copied from one template, with only the
+    y data (and title) filled in, and recently served figures are
+    cached by scan (or window). When there's no scan close enough
+    the figure says so instead of showing a far away scan.
+
+    mass_spec : a MassSpecStore
+    max_gap : furthest (in seconds) a scan can be from the time asked for, or None for no limit
+    max_overlay : most scans drawn when overlaying a window
+    """
+    MODES = ['nearest', 'mean', 'overlay']
+
+    def __init__(self, mass_spec, max_gap=None, max_overlay=20, cache_size=64):
+        self.mass_spec = mass_spec
+        self.max_gap = max_gap
+        self.max_overlay = max_overlay
+        self.cache = data_service.LRUCache(cache_size)
+
+        self.mass = mass_spec.mass.tolist()
+        self.template = {
+            'data': [{'type': 'scatter', 'mode': 'lines', 'x': self.mass, 'y': []}],
+            'layout': {
+                'xaxis': {'title': {'text': 'mass'}},
+                'yaxis': {'title': {'text': 'intensity'}},
+                'title': {'text': ''},
+            },
+        }
+
+    def _figure(self, traces, title):
+        figure = {'data': [], 'layout': dict(self.template['layout'], title={'text': title})}
+        for y, name in traces:
+            figure['data'].append(dict(self.template['data'][0], y=y, name=name))
+        return figure
+
+    def no_scan(self, timestamp):
+        gap = f" within {self.max_gap} s" if self.max_gap is not None else ""
+        figure = self._figure([([], '')], f"No scan{gap} of {timestamp}")
+        figure['layout']['annotations'] = [{
+            'text': 'No scan',
+            'showarrow': False,
+            'xref': 'paper', 'yref': 'paper', 'x': 0.5, 'y': 0.5,
+        }]
+        return figure
+
+    def nearest(self, timestamp):
+        index = self.mass_spec.nearest(timestamp, self.max_gap)
+        if index < 0:
+            return self.no_scan(timestamp)
+
+        scan_time = self.mass_spec.time[index]
+        figure = self.cache.get(('nearest', index), lambda: self._figure(
+            [(self.mass_spec.row(index).tolist(), str(scan_time))],
+            f"Scan at {scan_time}"
+        ))
+        # The gap differs for every click, so it's added to a copy of the cached figure
+        title = f"{figure['layout']['title']['text']} ({abs(timestamp - scan_time):.1f} s away)"
+        return dict(figure, layout=dict(figure['layout'], title={'text': title}))
+
+    def window(self, timestamp, seconds, mode='mean'):
+        """The scans within seconds/2 of timestamp, averaged or overlaid"""
+        start, end = timestamp - seconds/2, timestamp + seconds/2
+        lo = int(np.searchsorted(self.mass_spec.time, start, side='left'))
+        hi = int(np.searchsorted(self.mass_spec.time, end, side='right'))
+        if hi == lo:
+            return self.no_scan(timestamp)
+
+        def make():
+            times, intensity = self.mass_spec.time[lo:hi], np.asarray(self.mass_spec.intensity[lo:hi])
+            if mode == 'mean':
+                return self._figure([(intensity.mean(axis=0).tolist(), 'mean')], f"Mean of {hi - lo} scans")
+
+            # Evenly spaced scans when there are too many to draw
+            shown = np.unique(np.linspace(0, hi - lo - 1, min(hi - lo, self.max_overlay)).astype(int))
+            return self._figure(
+                [(intensity[i].tolist(), str(times[i])) for i in shown],
+                f"{len(shown)} of {hi - lo} scans"
+            )
+
+        # Keyed on the scans in the window, so nearby clicks share an entry
+        return self.cache.get((mode, lo, hi), make)
+
+    def figure(self, timestamp, mode='nearest', seconds=None):
+        if mode == 'nearest' or not seconds:
+            return self.nearest(timestamp)
+        return self.window(timestamp, seconds, mode)
+
+
+def load_mass_spec(path):
+    """Opens either a mass spec store or a directory of mass spec csvs as a MassSpecStore"""
+    if is_mass_spec_store(path):
+        return MassSpecStore.open(path)
+    return MassSpecStore.from_wide(get_wide_data(path))
 
 
 def get_args():
     """Basic argument parsing.
     for example:
-        python mass_spec_utils.py --data_dir ../data/J2-1393 --time 0"""
+        python mass_spec_utils.py --data_dir ../data/J2-1393 --time 0
+        python mass_spec_utils.py --data_dir ../data/J2-1393 --build_store ../data/mass_spec_store"""
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--data_dir', 
@@ -81,9 +333,16 @@ def get_args():
     parser.add_argument(
         '--time',
         type=float,
-        required=True,
+        default=None,
         help="Will show a cutout of mass spec at closest point to given time."
     )
+
+    parser.add_argument(
+        '--build_store',
+        type=str,
+        default=None,
+        help="Convert the csvs in data_dir into a memory mapped store in this directory"
+    )
     
 
     return parser.parse_args()
@@ -91,9 +350,13 @@ def get_args():
 
 if __name__ == "__main__":
     args = get_args()
-    wide_data = get_wide_data(args.data_dir)
 
-    utils.get_row_by_value(wide_data, 'time', args.time)[1:].plot()
-    plt.show()
+    if args.build_store is not None:
+        build_mass_spec_store(args.data_dir, args.build_store)
 
+    if args.time is not None:
+        mass_spec = load_mass_spec(args.data_dir)
+        index = mass_spec.time_index.nearest(args.time)
 
+        pd.Series(mass_spec.row(index), index=mass_spec.mass).plot()
+        plt.show()
@@ -1,90 +1,89 @@
-import cv2
-import matplotlib.pyplot as plt
-import sys
 import pandas as pd
-import os
 import numpy as np
-import json
 import argparse
+import threading
 
 import plotly.graph_objects as go
 import plotly.express as px
 
-from dash import Dash
+from dash import Dash, callback_context
 from dash import html, dcc
 from dash.dependencies import Input, Output
+from dash.exceptions import PreventUpdate
 
 # Custom files
-import video_extraction
-import combine_data
+import video_catalog
+import frame_server
+import video_proxies
 import utils
+import time_index
+import cache
+import dive_store
+import decimation
+import data_service
 
 
 
-def get_frames(video_dir):
+def get_frames(video_dir, catalog_path=None):
     """
     Given a directory of videos,
     this function will calculate the unix start and end time 
-    of each, and return a map from filename to the start and end times."""
-
-    start_end_by_file = {}
+    of each, and return a map from filename to the start and end times.
+    
+    Clip metadata comes from the video catalog, which is 
+    brought up to date first (only new or changed clips are probed)."""
+    catalog = video_catalog.VideoCatalog(video_dir, catalog_path)
+    catalog.update()
+    start_end_by_file = catalog.start_end_by_file()
+    catalog.close()
 
-    for filename in os.listdir(video_dir):
-        if filename.startswith('.'):
-            continue
-            
-        path = os.path.join(video_dir, filename)
-        
-        starttime = video_extraction.get_start_time(path)
-        
-        cap = cv2.VideoCapture(path)
-        
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        duration = frame_count/fps
+    return start_end_by_file
 
-        approx_endtime = starttime + duration
-        
-        start_end_by_file[filename] = (starttime, approx_endtime)
 
-    return start_end_by_file
+def assign_video_files(times, start_end_by_file):
+    """Given a series of times, and a map from file to start and
+    end time (or TimeIntervals built from one), finds the file covering 
+    every time in a single sorted pass. Overlaps are settled as in TimeIntervals.
+    
+    Returns categorical 'video_file' and 'color' columns, where 
+    color is the 1 based index of the file (as in time_index.time_to_file). 
+    Times outside every file are left missing."""
+    if not isinstance(start_end_by_file, time_index.TimeIntervals):
+        start_end_by_file = time_index.TimeIntervals.from_mapping(start_end_by_file)
 
+    positions = start_end_by_file.locate(np.asarray(times, dtype=np.float64))
+    clip_numbers = range(1, len(start_end_by_file) + 1)
 
-def time_to_file(time, start_end_by_file, return_int=False):
-    """Given a time, and a map from file to 
-    start and end time, return which file
-    time belongs in. (None if none)"""
-    index = 0
-    for file, (start, end) in start_end_by_file.items():
-        index += 1
-        if start <= time and time <= end:
-            if return_int:
-                return index
-            return file
-    return None
+    return pd.DataFrame({
+        'video_file': pd.Categorical.from_codes(positions, categories=start_end_by_file.labels),
+        'color': pd.Categorical.from_codes(positions, categories=clip_numbers),
+    }, index=getattr(times, 'index', None))
 
 
 class CaptureHolder():
     """
     This class is designed to aid in retrieving frames from a directory of videos 
-    without opening and closing files more than necessary.
+    without opening and closing files more than necessary. Frames come from a
+    frame_server.FrameServer, which keeps a pool of open files and a cache of frames.
+
+    Given a proxy_dir (from video_proxies.py), downscaled proxy frames are
+    served instead, and full resolution frames are only decoded on request.
     """
-    def __init__(self, video_dir):
-        self.cap = None
+    def __init__(self, video_dir, catalog_path=None, proxy_dir=None, proxy_width=320):
         self.file = None
         self.seconds = None
         self.video_dir = video_dir
+        self.server = frame_server.FrameServer(video_dir, catalog_path)
+        self.proxies = video_proxies.ProxyStore(proxy_dir) if proxy_dir else None
+        self.proxy_width = proxy_width
+        # The file and position are shared, so server threads take turns
+        self.lock = threading.Lock()
         
     def set_file(self, file):
-        if file == self.file:
-            return
-        else:
-            self.file = file
-            self.cap = cv2.VideoCapture(os.path.join(self.video_dir, file))
+        self.file = file
             
     def seek(self, seconds):
         self.seconds = seconds
-        self.cap.set(cv2.CAP_PROP_POS_MSEC, seconds*1000)
         
     def fast_forward(self):
         self.seek(self.seconds + 5)
@@ -92,29 +91,32 @@ class CaptureHolder():
     def rewind(self):
         self.seek(self.seconds - 5)
 
+    def get_frame(self, full_resolution=False):
+        if self.proxies is not None and not full_resolution:
+            frame = self.proxies.get_frame(self.file, self.seconds, self.proxy_width)
+            if frame is not None:
+                return frame
+        return self.server.get_frame(self.file, self.seconds)
 
-    def get_image(self, file, seconds):
+    def get_image(self, file, seconds, full_resolution=False):
         # gives a plotly figure of the specified image
-        self.set_file(os.path.join(self.video_dir, file))
+        with self.lock:
+            self.set_file(file)
 
-        self.seek(seconds)
+            self.seek(seconds)
 
-        ret, frame = self.cap.read()
-        
-        if not ret:
-            raise ValueError("Image not found")
-        
-        
-    #     CV2 seems to default to ordering the channels unusually
-    #     This orders them as rgb so that plotly understands it
-        return px.imshow(cv2.merge(cv2.split(frame)[::-1]))
+            frame = self.get_frame(full_resolution)
+        return px.imshow(frame)
 
 
 
 
-def run_server(fig, timeline, near_vent, start_end_by_file, cap):
+def create_app(make_figures, service, start_end_by_file, cap):
+    """Builds the dash app. make_figures(view) gives the spatial and timeline 
+    figures for a unix time range of the timeline (or None for all of it), 
+    and service is a data_service.DataService of the points shown."""
 
-    columns_of_interest = near_vent.columns
+    fig, timeline = make_figures()
 
     app = Dash(__name__)
 
@@ -142,6 +144,7 @@ def run_server(fig, timeline, near_vent, start_end_by_file, cap):
             dcc.Loading(children = [
                 dcc.Graph(id='camera'),
             ]),
+            html.Button('Full resolution', id='full_resolution'),
              
              html.Pre(id='sensor_display', style = styles['pre'])
         ], style = styles['display_wrapper']),
@@ -161,38 +164,48 @@ def run_server(fig, timeline, near_vent, start_end_by_file, cap):
         
     # SCRIPTING
     @app.callback(
-        Output(component_id = 'camera', component_property='figure'),
-        Input('timeline', 'clickData')
+        Output(component_id = 'spatial', component_property='figure'),
+        Output(component_id = 'timeline', component_property='figure'),
+        Input('timeline', 'relayoutData'),
+        prevent_initial_call=True
     )
-    def set_camera(node_clicked):
-        custom_data = node_clicked['points'][0]['customdata']
-        timestamp = data.loc[custom_data]['unix_time']
-        start = start_end_by_file[data.iloc[custom_data]['video_file']][0]
-        seek_dist = timestamp - start
-        return cap.get_image(data.iloc[custom_data]['video_file'], seek_dist)
-        
-        
+    def set_view(relayout_data):
+        # Picks the points to show again whenever the timeline is zoomed
+        view = decimation.timeline_view(relayout_data)
+        if view is decimation.UNCHANGED:
+            raise PreventUpdate
+        return make_figures(view)
+
+    def get_camera(label, full_resolution):
+        video_file = service.value(label, 'video_file')
+        seek_dist = service.value(label, 'unix_time') - start_end_by_file[video_file][0]
+        return cap.get_image(video_file, seek_dist, full_resolution)
+
     @app.callback(
+        Output(component_id = 'camera', component_property='figure'),
         Output(component_id = 'frame_selector', component_property='value'),
-        Input('timeline', 'clickData')
+        Output(component_id = 'sensor_display', component_property='children'),
+        Input('timeline', 'clickData'),
+        Input('full_resolution', 'n_clicks')
     )
-    def set_frame(node_clicked):
-        print(node_clicked)
-        return data.loc[node_clicked['points'][0]['customdata']]['unix_time']
+    def set_selection(node_clicked, full_resolution_clicks):
+        # Everything shown for a click comes from the one row lookup
+        label = data_service.clicked_label(node_clicked)
+        if label is None:
+            raise PreventUpdate
 
+        full_resolution = callback_context.triggered[0]['prop_id'] == 'full_resolution.n_clicks'
+        # Not kept in the service's caches, image figures are megabytes each. The
+        # decoded frames are cached (by size) in the frame server, so this is cheap
+        camera = get_camera(label, full_resolution)
+        return camera, service.value(label, 'unix_time'), service.readout(label)
 
+    return app
 
-    @app.callback(
-        Output(component_id = 'sensor_display', component_property='children'),
-        Input('timeline', 'clickData')
-    )
-    def set_sensor_readout(node_clicked):
-        node_index = node_clicked['points'][0]['customdata']
-        data = near_vent.loc[node_index][columns_of_interest].to_dict()
-        print(data)
-        return json.dumps(data, indent=2)
-    
 
+def run_server(make_figures, near_vent, start_end_by_file, cap):
+    service = data_service.DataService(near_vent)
+    app = create_app(make_figures, service, start_end_by_file, cap)
     app.run(port="8002", debug=True)
 
 
@@ -212,7 +225,7 @@ def get_args():
         "--data_file", 
         required=True,
         type=str, 
-        help="Expects a labeled csv file with at least columns labeled 'unix_time', 'northing', 'easting'"
+        help="Expects a labeled csv file (or partitioned parquet dataset) with at least columns labeled 'unix_time', 'northing', 'easting'"
     )
     parser.add_argument(
         "--video_dir",
@@ -220,12 +233,60 @@ def get_args():
         type=str,
         help="Directory with video related to the given data"
     )
+    parser.add_argument(
+        "--catalog",
+        default=None,
+        type=str,
+        help="Where to keep the video catalog, defaults to a hidden file in video_dir"
+    )
+    parser.add_argument(
+        "--proxy_dir",
+        default=None,
+        type=str,
+        help="Directory of proxy frames from video_proxies.py, served before full resolution frames"
+    )
     parser.add_argument(
         "--mesh_file",
         required=True,
         type=str,
         help="An unlabeled tsv file with column 1 latitude column 2 longitude and column 3 depth"
     )
+    parser.add_argument(
+        "--mesh_vertices",
+        default=20000,
+        type=int,
+        help="Vertex budget for the bathymetry mesh, picks the finest level of detail that fits"
+    )
+    parser.add_argument(
+        "--max_points",
+        default=5000,
+        type=int,
+        help="Most points to draw in each of the track and timeline, they're decimated to fit the current view"
+    )
+    parser.add_argument(
+        "--timeline_method",
+        default='minmax',
+        choices=sorted(decimation.TIMELINE_METHODS),
+        help="How the timeline is decimated"
+    )
+    parser.add_argument(
+        "--start_time",
+        default=None,
+        type=float,
+        help="Only load data from this unix time onwards"
+    )
+    parser.add_argument(
+        "--end_time",
+        default=None,
+        type=float,
+        help="Only load data up to this unix time"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        type=str,
+        help="Directory for caching parsed input files between runs"
+    )
 
     args = parser.parse_args()
     return args
@@ -236,52 +297,82 @@ if __name__ == '__main__':
 
     args = get_args()
 
-    start_end_by_file = get_frames(args.video_dir)
+    start_end_by_file = get_frames(args.video_dir, args.catalog)
 
-    data = pd.read_csv(args.data_file)
+    # TODO: This is specific to ring vent
+    data = cache.cached_load(
+        args.cache_dir, 
+        dive_store.read_dataset, 
+        args.data_file, 
+        time_range=(args.start_time, args.end_time), 
+        filters=[('depth', '<', -1700)],
+        report=True
+    )
             
-    cap = CaptureHolder(args.video_dir) # This keeps track of our video reading
+    cap = CaptureHolder(args.video_dir, args.catalog, args.proxy_dir) # This keeps track of our video reading
 
     # Set up point coloring
-    data['color'] = data.unix_time.apply(time_to_file, start_end_by_file=start_end_by_file, return_int=True)
-    data['video_file'] = data.unix_time.apply(time_to_file, start_end_by_file=start_end_by_file)
+    clips = assign_video_files(data.unix_time, start_end_by_file)
+    data['color'] = clips.color
+    data['video_file'] = clips.video_file
 
     # Get Mesh
-    mesh = utils.get_mesh(args.mesh_file, 1000)
+    mesh = utils.get_mesh(args.mesh_file, max_vertices=args.mesh_vertices, cache_dir=args.cache_dir)
     mesh.opacity = .3
     mesh.hoverinfo = "skip"
 
     # TODO: This is specific to ring vent
     near_vent = data.loc[np.where((data.depth < -1700) & (pd.notna(data.video_file)))]
     colors = ['rgba(0, 0, 0, .001)', *px.colors.DEFAULT_PLOTLY_COLORS]
-    # TODO: This isn't robust to a larger number of input files, need a larger color array
-    near_vent['rgb'] = near_vent.color.apply(lambda i: colors[int(i)] if pd.notna(i) else colors[0])
-    
-    scatterplot = go.Scatter3d(
-        x=near_vent.northing,
-        y=near_vent.easting,
-        z=near_vent.depth,
-        text = near_vent.unix_time,#data[pd.notna(data.video_file)].text,
-        mode='markers',
-        marker=dict(
-            color=near_vent.rgb,
-        ),
-        customdata = near_vent.index
-    )
-
-    PLOT_MESH = True
-    fig = go.Figure(data = ([mesh, scatterplot] if PLOT_MESH else [scatterplot]))
-
-    timeline_plot = go.Scatter(
-        x=near_vent.unix_time,
-        y=[0]*len(near_vent),
-        text = near_vent.unix_time,
-        mode="markers",
-        marker=dict(
-            color=near_vent.rgb,
-        ),
-        customdata=near_vent.index
+    # Clip numbers past the end of the palette wrap around to the start
+    color_codes = near_vent.color.cat.codes.to_numpy(np.int64) + 1
+    color_codes = np.where(color_codes > 0, (color_codes - 1) % (len(colors) - 1) + 1, 0)
+
+    marker = dict(
+        colorscale=decimation.discrete_colorscale(colors),
+        cmin=-.5,
+        cmax=len(colors) - .5,
     )
-    timeline = go.Figure(data = [timeline_plot])
 
-    run_server(fig, timeline, near_vent, start_end_by_file, cap)
\ No newline at end of file
+    def make_figures(view=None):
+        """The spatial and timeline figures for the points in view (a unix time
+        range, or everything), decimated to at most args.max_points each"""
+        in_view = decimation.in_view(near_vent.unix_time, view)
+        points = near_vent.iloc[in_view]
+
+        track = in_view[decimation.voxel(points.northing, points.easting, points.depth, args.max_points)]
+        track_points = near_vent.iloc[track]
+        scatterplot = go.Scatter3d(
+            x=track_points.northing,
+            y=track_points.easting,
+            z=track_points.depth,
+            text = track_points.unix_time,
+            mode='markers',
+            marker=dict(color=color_codes[track], **marker),
+            customdata = track_points.index
+        )
+
+        PLOT_MESH = True
+        fig = go.Figure(data = ([mesh, scatterplot] if PLOT_MESH else [scatterplot]))
+        fig.update_layout(uirevision='spatial')
+
+        # Thinned on depth and drawn against it, so the timeline shows the ups and downs of the dive
+        method = decimation.TIMELINE_METHODS[args.timeline_method]
+        times = in_view[method(points.unix_time, points.depth, args.max_points)]
+        timeline_points = near_vent.iloc[times]
+        timeline_plot = go.Scattergl(
+            x=timeline_points.unix_time,
+            y=timeline_points.depth,
+            text = timeline_points.unix_time,
+            mode="markers",
+            marker=dict(color=color_codes[times], **marker),
+            customdata=timeline_points.index
+        )
+        timeline = go.Figure(data = [timeline_plot])
+        timeline.update_layout(uirevision='timeline', yaxis_title='depth')
+        if view is not None:
+            timeline.update_xaxes(range=list(view))
+
+        return fig, timeline
+
+    run_server(make_figures, near_vent, start_end_by_file, cap)
@@ -0,0 +1,340 @@
+"""
+A registry of the sensor file formats the pipeline reads.
+
+Each instrument is described once by a SensorFormat: the fields on each
+line, which of them to keep, which stay strings (everything else kept is
+parsed straight to float64), and how to get a unix time for each row.
+Every format is read by the same fast path (one tokenizing pass over the
+file, or two for lumped files with empty fields, only materializing the
+kept columns), and the rows, parse failures
+and time ordering of each file are attached to the result as
+data.attrs['validation'], with a warning printed for any problems.
+
+Adding an instrument for a new dive is a matter of registering it:
+    sensor_formats.register(sensor_formats.SensorFormat(
+        'FLR',
+        fields=['sensor1', 'date', 'time', 'sensor2', 'chlorophyll'],
+        keep=['date', 'time', 'chlorophyll'],
+        extensions=['FLR'],
+    ))
+after which utils.load_from_file reads any .FLR file.
+"""
+import io
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+import conversions
+
+# Number of lines tokenized at once when streaming a file
+DEFAULT_CHUNKSIZE = 100000
+
+# Name of the unix time column added to every format with a timestamp rule
+TIME_COLUMN = 'unix_time'
+
+_COMMA_TO_SPACE = bytes.maketrans(b',', b' ')
+
+
+def date_time_columns(date_column='date', time_column='time'):
+    """Timestamp rule for separate date (YYYY/MM/DD) and time (HH:MM:SS.fff) columns"""
+    def timestamp(data):
+        return conversions.dates_times_to_unix(data[date_column], data[time_column])
+    timestamp.columns = [date_column, time_column]
+    return timestamp
+
+
+def unix_column(column):
+    """Timestamp rule for a column that's already in unix time"""
+    def timestamp(data):
+        return data[column]
+    timestamp.columns = [column]
+    return timestamp
+
+
+def datetime_column(column):
+    """Timestamp rule for a single 'date time' column"""
+    def timestamp(data):
+        pieces = data[column].str.split(' ', n=1, expand=True)
+        return conversions.dates_times_to_unix(pieces[0], pieces[1])
+    timestamp.columns = [column]
+    return timestamp
+
+
+def _has_empty_field(lines):
+    """Whether any comma separated field is empty, such as a,,b or a trailing comma"""
+    compact = b'\n' + lines.translate(None, b' \t\r') + b'\n'
+    return b',,' in compact or b',\n' in compact or b'\n,' in compact
+
+
+class SensorFormat():
+    """
+    name : what the format is registered (and asked for) as
+    fields : name of each field on a line, in order. None for files with a header line
+    keep : the fields to materialize, defaults to all of them
+    strings : fields that stay strings. In tokenized formats everything else kept
+            is float64, in comma separated ones the types are inferred
+    tokenizer : 'lumped' where the leading fields are separated by whitespace
+            and the rest by commas, 'whitespace', or 'comma' for properly
+            comma separated files
+    lumped : number of leading whitespace separated fields in a 'lumped'
+            format, defaults to all of them
+    timestamp : rule giving each row's unix time (added as a unix_time column), or None.
+            Rules list the columns they need as timestamp.columns
+    extensions : file extensions read as this format by default
+    line_column : if given, each raw line is also kept in a column with this name
+    required : columns whose missing values count as parse failures, defaults to keep
+    comment : character starting a comment
+    """
+    def __init__(self, name, fields, keep=None, strings=('sensor1', 'sensor2', 'date', 'time'),
+                 tokenizer='lumped', lumped=None, timestamp=date_time_columns(), extensions=(),
+                 line_column=None, required=None, comment='#'):
+        self.name = name
+        self.fields = fields
+        self.keep = list(keep) if keep is not None else fields
+        self.strings = set(strings)
+        self.tokenizer = tokenizer
+        self.lumped = lumped if lumped is not None else len(fields or [])
+        self.timestamp = timestamp
+        self.extensions = [extension.upper() for extension in extensions]
+        self.line_column = line_column
+        self.required = list(required) if required is not None else self.keep
+        self.comment = comment
+
+    def dtypes(self, keep):
+        if self.tokenizer == 'comma' and not self.strings:
+            return None
+        if self.tokenizer == 'comma':
+            return {column: str for column in keep if column in self.strings}
+        return {column: (str if column in self.strings else np.float64) for column in keep}
+
+    def _read_lumped(self, lines, keep, dtype):
+        # The comma separated fields are read in place (so empty ones stay
+        # missing), with the leading fields read as one, then split on whitespace
+        lumped, rest = self.fields[:self.lumped], self.fields[self.lumped:]
+        keep = keep if keep is not None else self.fields
+        dtypes = dtype if isinstance(dtype, dict) else {column: dtype for column in self.fields}
+
+        data = pd.read_csv(
+            io.BytesIO(lines),
+            sep=',',
+            header=None,
+            names=['_lumped'] + rest,
+            usecols=['_lumped'] + [column for column in rest if column in keep],
+            dtype={'_lumped': str, **{column: dtypes[column] for column in rest if column in dtypes}},
+            comment=self.comment
+        )
+        leading = pd.read_csv(
+            io.StringIO('\n'.join(data.pop('_lumped').fillna(''))),
+            sep=r'\s+',
+            header=None,
+            names=lumped,
+            usecols=[column for column in lumped if column in keep],
+            dtype={column: dtypes[column] for column in lumped if column in dtypes},
+            skip_blank_lines=False
+        )
+        leading.index = data.index
+        return pd.concat([leading, data], axis=1)
+
+    def parse(self, lines, keep):
+        """Parses a block of whole lines (bytes) into the kept columns"""
+        tokenizer = self.tokenizer
+        if tokenizer == 'lumped' and self.lumped < len(self.fields):
+            if _has_empty_field(lines):
+                tokenizer = 'split'
+            else:
+                # Without empty fields the fields are the same whichever
+                # character separates them, so it's one whitespace read
+                lines = lines.translate(_COMMA_TO_SPACE)
+
+        def read_lines(dtype):
+            if tokenizer == 'split':
+                return self._read_lumped(lines, keep, dtype)
+            return pd.read_csv(
+                io.BytesIO(lines),
+                sep=',' if tokenizer == 'comma' else r'\s+',
+                header=None if self.fields is not None else 0,
+                names=self.fields,
+                usecols=keep,
+                dtype=dtype,
+                comment=self.comment
+            )
+
+        dtypes = self.dtypes(keep) if keep is not None else None
+        try:
+            data = read_lines(dtypes)
+        except ValueError:
+            if not dtypes:
+                raise
+            # A malformed value somewhere, so read everything as strings and
+            # leave whatever doesn't parse missing (counted by validate)
+            data = read_lines(str)
+            for column, dtype in dtypes.items():
+                if dtype is not str:
+                    data[column] = pd.to_numeric(data[column], errors='coerce')
+        if keep is not None:
+            data = data[keep]
+
+        if self.line_column is not None:
+            # None of the line formats have commas, so each line is read as one field
+            raw = pd.read_csv(io.BytesIO(lines), header=None, names=[self.line_column])
+            data.insert(0, self.line_column, raw[self.line_column].to_numpy())
+
+        if self.timestamp is not None:
+            data[TIME_COLUMN] = self.timestamp(data)
+        return data
+
+
+FORMATS = {}
+
+
+def register(sensor_format):
+    """Adds a format to the registry (replacing any with the same name)"""
+    FORMATS[sensor_format.name.upper()] = sensor_format
+    return sensor_format
+
+
+def get_format(name):
+    try:
+        return FORMATS[name.upper()]
+    except KeyError:
+        raise ValueError(f"Unknown sensor format {name}, expected one of {sorted(FORMATS)}") from None
+
+
+def format_for_path(path):
+    """The format registered for a file's extension"""
+    extension = path.split('.')[-1].upper()
+    for sensor_format in FORMATS.values():
+        if extension in sensor_format.extensions:
+            return sensor_format
+    raise ValueError(f"No sensor format registered for .{extension} files ({path})")
+
+
+def validate(data, sensor_format, path):
+    """Counts rows, parse failures (rows missing a required column, or a time),
+    and rows out of time order. Attaches them to data.attrs, and warns about any problems."""
+    required = [column for column in sensor_format.required if column in data.columns]
+    failures = data[required].isna().any(axis=1) if required else pd.Series(False, index=data.index)
+
+    stats = {'rows': len(data)}
+    if TIME_COLUMN in data.columns:
+        times = np.asarray(data[TIME_COLUMN], dtype=np.float64)
+        failures = failures | np.isnan(times)
+        steps = np.diff(times[~np.isnan(times)])
+        stats['out_of_order'] = int(np.count_nonzero(steps < 0))
+        stats['duplicate_times'] = int(np.count_nonzero(steps == 0))
+    stats['parse_failures'] = int(np.count_nonzero(failures))
+
+    data.attrs['validation'] = stats
+    if stats['parse_failures'] or stats.get('out_of_order'):
+        print(f"Warning, {path} ({sensor_format.name}): " + ', '.join(f"{name} {value}" for name, value in stats.items()))
+    return stats
+
+
+def read(path, format=None, chunksize=None, columns=None):
+    """
+    Reads a sensor file in a single tokenizing pass.
+
+    format : name of a registered format, defaults to the one for the file extension
+    chunksize : if given, returns an iterator of DataFrames with at most
+                chunksize rows each rather than loading the whole file
+    columns : only materialize these columns (of the format's kept ones)
+    """
+    sensor_format = get_format(format) if format is not None else format_for_path(path)
+
+    keep = sensor_format.keep
+    if columns is not None:
+        # Whatever the timestamp is made from is always read
+        needed = list(getattr(sensor_format.timestamp, 'columns', []))
+        needed += [column for column in columns if column not in needed]
+        keep = [column for column in (keep or needed) if column in needed]
+
+    if chunksize is None:
+        with open(path, 'rb') as f:
+            data = sensor_format.parse(f.read(), keep)
+        validate(data, sensor_format, path)
+        return data
+
+    return _iter_chunks(path, sensor_format, keep, chunksize)
+
+
+def _iter_chunks(path, sensor_format, keep, chunksize):
+    with open(path, 'rb') as f:
+        # Formats with a header line get it at the top of every chunk
+        header = f.readline() if sensor_format.fields is None else b''
+        while True:
+            lines = b''.join(islice(f, chunksize))
+            if not lines:
+                return
+            data = sensor_format.parse(header + lines, keep)
+            validate(data, sensor_format, path)
+            yield data
+
+
+NAV_FIELDS = [
+    'Vehicle', 'year', 'month', 'day', 'hour', 'minutes', 'seconds', 'time(seconds since Jan 1 1970)',
+    'latitude(deg)', 'longitude(deg)', 'X local(m)', 'Y local(m)', 'latitude origin(deg)',
+    'longitude origin(deg)', 'X UTM(m)', 'Y UTM(m)', 'UTMZone', 'depth(m)', 'altitude(m)',
+    'octans heading(deg)', 'octans pitch(deg)', 'octans roll(deg)', 'crossbow heading(deg)',
+    'crossbow pitch(deg)', 'crossbow roll(deg)', 'maggie x', 'maggie y', 'maggie z', 'maggie total',
+    'conductivity', 'temperature(deg C)', 'depth(m)_2', 'salinity', 'sound velocity', 'pressure',
+    'lss gain', 'lss backscatter', "None"
+]
+
+register(SensorFormat(
+    'CSV',
+    fields=NAV_FIELDS,
+    strings=(),
+    tokenizer='comma',
+    timestamp=unix_column('time(seconds since Jan 1 1970)'),
+    extensions=['CSV'],
+    required=['time(seconds since Jan 1 1970)', 'latitude(deg)', 'longitude(deg)'],
+))
+
+register(SensorFormat(
+    'CT2',
+    fields=["sensor1", "date", "time", "sensor2", "temperature", "conductivity", "pressure", "salinity", "sound_speed"],
+    keep=["date", "time", "temperature", "salinity", "conductivity", "pressure"],
+    lumped=5,
+    extensions=['CT2'],
+))
+
+register(SensorFormat(
+    'OBS',
+    fields=["sensor1", "date", "time", "sensor2", "obs", "_1", "_2", "_3"],
+    keep=["date", "time", "obs"],
+    extensions=['OBS'],
+))
+
+register(SensorFormat(
+    'OOS',
+    fields=[
+        "sensor1", "date", "time", "sensor2", "_1", "_2", "_3", "_4", "oxygen", "_5", "air_saturation",
+        "_6", "temperature_c", "_7", "cal_phase", "_8", "tc_phase", "_9", "c1rph", "_10", "c2rph",
+        "_11", "c1amp", "_12", "c2amp", "_13", "raw_temp_mv"
+    ],
+    keep=["date", "time", "oxygen"],
+    extensions=['OOS'],
+))
+
+# Every field stays a string (cleaned up after merging), along with the whole line
+register(SensorFormat(
+    'RENAV',
+    fields=["date", "time", "lat", "lon", "depth", "ua", "ub", "uc", "ud"],
+    strings=["date", "time", "lat", "lon", "depth", "ua", "ub", "uc", "ud"],
+    tokenizer='whitespace',
+    extensions=['PPI'],
+    line_column='lump',
+    required=["date", "time", "lat", "lon", "depth"],
+    comment=None,
+))
+
+register(SensorFormat(
+    'METHANE',
+    fields=None,
+    strings=(),
+    tokenizer='comma',
+    timestamp=datetime_column('timestamp'),
+    required=['timestamp', 'methane'],
+    comment=None,
+))
@@ -0,0 +1,246 @@
+"""
+Writes a synthetic dive laid out like the real J2-1393 data, for benchmarking
+and trying out the tools without the (unshipped) cruise data.
+
+    out_dir/
+        csv/, ct2/, obs/, oos/     one file per day, YYYYMMDD.<EXT>
+        navest/J2-1393_renav.ppi
+        methane.csv
+        mass_spec/ms_###.csv
+        ring_depth.tsv
+        synthetic.json             the parameters everything was made with
+
+The vehicle follows a smooth track around the vent at about -1700 m, and
+every stream is logged at its own rate with its own offset from the nav
+clock, as the real instruments are. combine_data.py skips the first day
+of a dive, so one more day than asked for is written.
+"""
+import os
+import csv
+import json
+import argparse
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import combine_data
+
+# Around the ring vent
+ORIGIN_LAT = 41.5
+ORIGIN_LON = -70.6
+VENT_DEPTH = -1700
+
+# Offsets (in seconds) of each stream's readings from the nav clock
+OFFSETS = {'ct2': .3, 'obs': .7, 'oos': .1, 'renav': -.5, 'methane': .25}
+
+MASS_SPEC_FILE_SCANS = 500
+
+
+def _strings(values, fmt):
+    return np.char.mod(fmt, values)
+
+
+def _dates_times(times):
+    """YYYY/MM/DD and HH:MM:SS.fff strings for unix times"""
+    stamps = pd.to_datetime(np.round(times * 1000).astype(np.int64), unit='ms')
+    return stamps.strftime('%Y/%m/%d').to_numpy(), stamps.strftime('%H:%M:%S.%f').str[:-3].to_numpy()
+
+
+def _write_table(path, columns, sep=' ', header=None):
+    """Writes equal length columns of strings (or single values) as lines"""
+    data = pd.DataFrame({position: column for position, column in enumerate(columns)})
+    with open(path, 'w', newline='') as f:
+        if header is not None:
+            f.write(header + '\n')
+        data.to_csv(f, sep=sep, header=False, index=False, quoting=csv.QUOTE_NONE)
+
+
+def _readings(times, hz):
+    """Times within [start, end) at the given rate"""
+    return np.arange(times[0], times[1], 1 / hz)
+
+
+def track(times):
+    """Latitude, longitude and depth of the vehicle at each unix time"""
+    lat = ORIGIN_LAT + .002 * np.sin(times / 1800) + .0005 * np.sin(times / 170)
+    lon = ORIGIN_LON + .003 * np.cos(times / 2400) + .0005 * np.cos(times / 230)
+    depth = VENT_DEPTH + 8 * np.sin(times / 900) + 2 * np.sin(times / 61)
+    return lat, lon, depth
+
+
+def write_nav(path, times, rng):
+    lat, lon, depth = track(times)
+    dates = pd.to_datetime(np.floor(times).astype(np.int64), unit='s')
+    n = len(times)
+    noise = lambda scale, center=0: _strings(center + scale * rng.standard_normal(n), '%.3f')
+    _write_table(path, [
+        'J2', dates.year, dates.month, dates.day, dates.hour, dates.minute, dates.second,
+        _strings(times, '%.3f'), _strings(lat, '%.7f'), _strings(lon, '%.7f'),
+        noise(50), noise(50),                                   # X, Y local
+        _strings(lat - ORIGIN_LAT, '%.6f'), _strings(lon - ORIGIN_LON, '%.6f'),
+        noise(50, 366000), noise(50, 4595000), 19,              # UTM x, y, zone
+        _strings(-depth, '%.2f'), noise(1, 5),                  # depth, altitude
+        noise(90, 180), noise(2), noise(2),                     # octans heading, pitch, roll
+        noise(90, 180), noise(2), noise(2),                     # crossbow heading, pitch, roll
+        noise(100), noise(100), noise(100), noise(100, 50000),  # magnetometer
+        noise(.01, 3.2), noise(.05, 2.8), _strings(-depth, '%.2f'),
+        noise(.01, 34.9), noise(.5, 1490), noise(1, 1720),
+        noise(1, 10), noise(5, 100), '',
+    ], sep=',')
+
+
+def write_ct2(path, times, rng):
+    dates, clock = _dates_times(times)
+    n = len(times)
+    readings = [
+        _strings(2.8 + .3 * rng.standard_normal(n), '%.4f'),     # temperature
+        _strings(3.2 + .01 * rng.standard_normal(n), '%.4f'),    # conductivity
+        _strings(1720 + rng.standard_normal(n), '%.3f'),         # pressure
+        _strings(34.9 + .01 * rng.standard_normal(n), '%.4f'),   # salinity
+        _strings(1490 + .5 * rng.standard_normal(n), '%.2f'),    # sound speed
+    ]
+    # The first reading follows a space, and the rest commas
+    first = np.char.add(np.char.add(np.char.add(np.char.add('CT2 ', dates), ' '), clock), ' SBE ')
+    _write_table(path, [np.char.add(first, readings[0]), *readings[1:]], sep=',')
+
+
+def write_obs(path, times, rng):
+    dates, clock = _dates_times(times)
+    obs = _strings(np.abs(.05 + .02 * rng.standard_normal(len(times))), '%.4f')
+    _write_table(path, ['OBS', dates, clock, 'S2', obs, 1, 2, 3])
+
+
+def write_oos(path, times, rng):
+    dates, clock = _dates_times(times)
+    n = len(times)
+    values = [_strings(rng.standard_normal(n), '%.3f') for _ in range(23)]
+    values[4] = _strings(250 + 5 * rng.standard_normal(n), '%.3f')   # oxygen
+    _write_table(path, ['OOS', dates, clock, 'S2', *values])
+
+
+def write_renav(path, times, rng):
+    dates, clock = _dates_times(times)
+    lat, lon, depth = track(times)
+    depth = depth + .5 * rng.standard_normal(len(times))
+    _write_table(path, [
+        dates, clock, _strings(lat, '%.7f'), _strings(lon, '%.7f'), _strings(depth, '%.2f'), 0, 0, 0, 0
+    ])
+
+
+def write_methane(path, times, rng, duplicate_every=10):
+    n = len(times)
+    stamps = pd.to_datetime(np.round(times * 1e6).astype(np.int64), unit='us').strftime('%Y-%m-%d %H:%M:%S.%f')
+    columns = [
+        stamps.to_numpy(),
+        _strings(rng.random(n), '%.3f'),
+        _strings(rng.random(n), '%.3f'),
+        _strings(2 + rng.random(n), '%.3f'),
+    ]
+    # The real file repeats rows exactly now and then
+    rows = np.sort(np.concatenate([np.arange(n), np.arange(0, n, duplicate_every)]))
+    _write_table(path, [column[rows] for column in columns], sep=',', header='timestamp,fundamental,ringdown,methane')
+
+
+def write_mass_spec(mass_spec_dir, times, masses, rng, file_scans=MASS_SPEC_FILE_SCANS):
+    """Each file has the scan times (in scott time) across the top, and a row per mass"""
+    os.makedirs(mass_spec_dir, exist_ok=True)
+    mass = np.arange(1, masses + 1, dtype=np.float64)
+    scott_times = (times + 62167287600.0) / (24*60*60)
+
+    for number, start in enumerate(range(0, len(times), file_scans)):
+        scans = scott_times[start:start + file_scans]
+        intensity = rng.random((masses, len(scans))) * np.exp(-mass / 20)[:, None]
+        with open(os.path.join(mass_spec_dir, f"ms_{number:03d}.csv"), 'w') as f:
+            f.write('0.0,' + ','.join(_strings(scans, '%.10f')) + '\n')
+            np.savetxt(f, np.column_stack([mass, intensity]), fmt='%.6g', delimiter=',')
+
+
+def write_bathymetry(path, grid_size, rng):
+    """A tab separated longitude, latitude, depth grid over the
+    track, with a ring shaped ridge around the vent"""
+    lon, lat = np.meshgrid(
+        np.linspace(ORIGIN_LON - .005, ORIGIN_LON + .005, grid_size),
+        np.linspace(ORIGIN_LAT - .004, ORIGIN_LAT + .004, grid_size),
+    )
+    radius = np.hypot((lon - ORIGIN_LON) / .003, (lat - ORIGIN_LAT) / .002)
+    depth = VENT_DEPTH - 10 + 15 * np.exp(-(radius - 1)**2 * 8) + .3 * rng.standard_normal(lon.shape)
+    _write_table(path, [
+        _strings(lon.ravel(), '%.5f'), _strings(lat.ravel(), '%.5f'), _strings(depth.ravel(), '%.2f')
+    ], sep='\t')
+
+
+def write_dive(out_dir, days=2, hours=24, start_date='2021-08-11', nav_hz=1.0, ct2_hz=1.0,
+               obs_hz=.5, oos_hz=1/3, renav_hz=.5, methane_hz=1.0, scan_seconds=10.0,
+               masses=100, grid_size=500, seed=0):
+    """
+    Writes a synthetic dive to out_dir, returning the parameters used.
+
+    days : days combine_data.py will process (one more is written before them)
+    hours : hours logged each day
+    *_hz : logging rate of each stream
+    scan_seconds : seconds between mass spec scans
+    masses : masses measured in each scan
+    grid_size : points along each side of the bathymetry grid
+    """
+    parameters = {
+        'days': days, 'hours': hours, 'start_date': start_date, 'nav_hz': nav_hz,
+        'ct2_hz': ct2_hz, 'obs_hz': obs_hz, 'oos_hz': oos_hz, 'renav_hz': renav_hz,
+        'methane_hz': methane_hz, 'scan_seconds': scan_seconds, 'masses': masses,
+        'grid_size': grid_size, 'seed': seed,
+    }
+    rng = np.random.default_rng(seed)
+    for extension in [*combine_data.extensions, 'navest']:
+        os.makedirs(os.path.join(out_dir, extension), exist_ok=True)
+
+    start = datetime.datetime.fromisoformat(start_date).replace(tzinfo=datetime.timezone.utc).timestamp()
+    spans = [(start + day * 86400, start + day * 86400 + hours * 3600) for day in range(days + 1)]
+
+    for span in spans:
+        file_day = datetime.datetime.fromtimestamp(span[0], datetime.timezone.utc).strftime('%Y%m%d')
+        paths = combine_data.get_day_paths(out_dir, file_day)
+        write_nav(paths['csv'], _readings(span, nav_hz), rng)
+        write_ct2(paths['ct2'], _readings(span, ct2_hz) + OFFSETS['ct2'], rng)
+        write_obs(paths['obs'], _readings(span, obs_hz) + OFFSETS['obs'], rng)
+        write_oos(paths['oos'], _readings(span, oos_hz) + OFFSETS['oos'], rng)
+
+    def over_dive(hz, offset):
+        return np.concatenate([_readings(span, hz) for span in spans]) + offset
+
+    write_renav(os.path.join(out_dir, combine_data.RENAV_FILE), over_dive(renav_hz, OFFSETS['renav']), rng)
+    write_methane(os.path.join(out_dir, 'methane.csv'), over_dive(methane_hz, OFFSETS['methane']), rng)
+    write_mass_spec(os.path.join(out_dir, 'mass_spec'), over_dive(1 / scan_seconds, 0), masses, rng)
+    write_bathymetry(os.path.join(out_dir, 'ring_depth.tsv'), grid_size, rng)
+
+    with open(os.path.join(out_dir, 'synthetic.json'), 'w') as f:
+        json.dump(parameters, f, indent=2)
+    return parameters
+
+
+def get_args():
+    """
+    Example command:
+        python synthetic_data.py --out_dir ../data/synthetic --days 3 --nav_hz 2
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out_dir', required=True, type=str, help="Directory to write the dive to")
+    parser.add_argument('--days', default=2, type=int, help="Days for combine_data.py to process")
+    parser.add_argument('--hours', default=24, type=float, help="Hours logged each day")
+    parser.add_argument('--start_date', default='2021-08-11', type=str, help="First day written (YYYY-MM-DD)")
+    parser.add_argument('--nav_hz', default=1.0, type=float, help="Rate of the navigation csv")
+    parser.add_argument('--ct2_hz', default=1.0, type=float, help="Rate of the CT2 readings")
+    parser.add_argument('--obs_hz', default=.5, type=float, help="Rate of the OBS readings")
+    parser.add_argument('--oos_hz', default=1/3, type=float, help="Rate of the oxygen readings")
+    parser.add_argument('--renav_hz', default=.5, type=float, help="Rate of the renav positions")
+    parser.add_argument('--methane_hz', default=1.0, type=float, help="Rate of the methane readings")
+    parser.add_argument('--scan_seconds', default=10.0, type=float, help="Seconds between mass spec scans")
+    parser.add_argument('--masses', default=100, type=int, help="Masses in each mass spec scan")
+    parser.add_argument('--grid_size', default=500, type=int, help="Points along each side of the bathymetry grid")
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    parameters = write_dive(**vars(args))
+    print(json.dumps(parameters, indent=2))
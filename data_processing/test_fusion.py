@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.interpolate import interp1d
+
+import fusion
+
+
+def test_linear_join_matches_interp1d():
+    times = np.array([0., 1., 3., 4.])
+    values = np.array([2., 4., 1., 5.])
+    reference = np.array([-1., 0., .5, 2., 4., 6.])
+
+    projected = fusion.LinearJoin(times, values, 'obs_proj').project(reference)
+    expected = interp1d(times, values, fill_value='extrapolate')(reference)
+    np.testing.assert_array_equal(projected, expected)
+
+
+@pytest.mark.parametrize('count', [0, 1])
+def test_linear_join_needs_two_readings(count):
+    with pytest.raises(ValueError, match='obs_proj'):
+        fusion.LinearJoin(np.arange(count, dtype=float), np.ones(count), 'obs_proj')
+
+
+def test_streaming_linear_join_needs_two_readings():
+    chunks = [pd.DataFrame({'unix_time': [1.], 'obs': [2.]})]
+    join = fusion.StreamingLinearJoin(chunks, 'unix_time', 'obs', 'obs_proj')
+    with pytest.raises(ValueError, match='obs_proj'):
+        join.join_for(np.array([0., 1., 2.]))
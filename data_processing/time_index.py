@@ -0,0 +1,161 @@
+"""
+Lookups into arrays of unix times.
+
+TimeIndex is built once over an array of times and answers nearest,
+left (at or before) and right (at or after) queries for single times or
+whole arrays with np.searchsorted. TimeIntervals does the same for a set of
+(start, end) spans, such as the start and end time of each video clip.
+
+Lookups return positions into the arrays they were built from,
+with -1 wherever nothing matches.
+"""
+import numpy as np
+
+
+class TimeIndex():
+    """
+    A sorted view of an array of times.
+
+    times : array of times, in any order unless assume_sorted is set
+    assume_sorted : skip checking the order, for arrays known to be sorted
+    """
+    def __init__(self, times, assume_sorted=False):
+        times = np.asarray(times, dtype=np.float64)
+        self.order = None
+
+        if not assume_sorted and np.any(times[1:] < times[:-1]):
+            self.order = np.argsort(times, kind='stable')
+            times = times[self.order]
+
+        self.times = times
+
+    def __len__(self):
+        return len(self.times)
+
+    def _finish(self, positions, valid, scalar):
+        positions = np.where(valid, positions, -1)
+        if self.order is not None:
+            positions = np.where(valid, self.order[np.clip(positions, 0, None)], -1)
+        return int(positions) if scalar else positions
+
+    def _within(self, valid, values, positions, tolerance):
+        if tolerance is None:
+            return valid
+        found = self.times[np.clip(positions, 0, len(self.times) - 1)]
+        return valid & (np.abs(values - found) <= tolerance)
+
+    def left(self, values, tolerance=None):
+        """The last entry at or before each value"""
+        scalar = np.ndim(values) == 0
+        values = np.asarray(values, dtype=np.float64)
+
+        positions = np.searchsorted(self.times, values, side='right') - 1
+        valid = (positions >= 0) & ~np.isnan(values)
+        return self._finish(positions, self._within(valid, values, positions, tolerance), scalar)
+
+    def right(self, values, tolerance=None):
+        """The first entry at or after each value"""
+        scalar = np.ndim(values) == 0
+        values = np.asarray(values, dtype=np.float64)
+
+        positions = np.searchsorted(self.times, values, side='left')
+        valid = (positions < len(self.times)) & ~np.isnan(values)
+        return self._finish(positions, self._within(valid, values, positions, tolerance), scalar)
+
+    def nearest(self, values, tolerance=None):
+        """The closest entry to each value (the earlier one on ties),
+        or -1 if it's further away than tolerance"""
+        scalar = np.ndim(values) == 0
+        values = np.asarray(values, dtype=np.float64)
+        last = len(self.times) - 1
+
+        if last < 0:
+            return self._finish(np.zeros(values.shape, dtype=np.int64), False, scalar)
+
+        after = np.clip(np.searchsorted(self.times, values, side='left'), 0, last)
+        before = np.clip(after - 1, 0, last)
+        use_after = np.abs(self.times[after] - values) < np.abs(values - self.times[before])
+        positions = np.where(use_after, after, before)
+
+        valid = ~np.isnan(values)
+        return self._finish(positions, self._within(valid, values, positions, tolerance), scalar)
+
+    def between(self, start, end):
+        """Every entry with start <= time <= end, in time order"""
+        lo = np.searchsorted(self.times, start, side='left')
+        hi = np.searchsorted(self.times, end, side='right')
+        positions = np.arange(lo, hi)
+        return positions if self.order is None else self.order[positions]
+
+
+class TimeIntervals():
+    """
+    A set of (start, end) spans of time, for finding the span containing each time.
+
+    Where spans overlap, a time belongs to the span that started most
+    recently, unless that span has already ended, in which case it belongs
+    to whichever earlier span runs the longest (if it still covers the time).
+    """
+    def __init__(self, starts, ends, labels=None):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+
+        self.labels = list(labels) if labels is not None else list(range(len(starts)))
+        self.order = np.argsort(starts, kind='stable')
+        self.starts = starts[self.order]
+        self.ends = ends[self.order]
+
+        # For each span (by start), the longest running span started so far
+        positions = np.arange(len(self.ends))
+        self.running_end = np.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+        self.running_index = np.maximum.accumulate(
+            np.where(self.ends >= self.running_end, positions, 0)
+        ) if len(self.ends) else positions
+
+    @classmethod
+    def from_mapping(cls, start_end_by_label):
+        """Builds intervals from a map of label to (start, end), such as the
+        output of get_frames. Positions follow the order of the map."""
+        labels = list(start_end_by_label.keys())
+        spans = np.array([start_end_by_label[label] for label in labels], dtype=np.float64).reshape(-1, 2)
+        return cls(spans[:, 0], spans[:, 1], labels)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def locate(self, values):
+        """The position of the interval containing each value, or -1"""
+        scalar = np.ndim(values) == 0
+        values = np.asarray(values, dtype=np.float64)
+
+        latest = np.searchsorted(self.starts, values, side='right') - 1
+        started = latest >= 0
+        latest = np.clip(latest, 0, None)
+
+        if len(self.starts) == 0:
+            positions = np.full(values.shape, -1)
+        else:
+            in_latest = started & (values <= self.ends[latest])
+            in_running = started & (values <= self.running_end[latest])
+            sorted_positions = np.where(in_latest, latest, self.running_index[latest])
+            positions = np.where(in_running, self.order[sorted_positions], -1)
+
+        return int(positions) if scalar else positions
+
+    def label(self, value):
+        """The label of the interval containing value, or None"""
+        position = self.locate(value)
+        return None if position < 0 else self.labels[position]
+
+
+def time_to_file(time, start_end_by_file, return_int=False):
+    """Given a time, and a map from file to start and end time (or
+    TimeIntervals built from one), return which file time belongs in
+    (None if none), or with return_int, its 1 based position"""
+    if not isinstance(start_end_by_file, TimeIntervals):
+        start_end_by_file = TimeIntervals.from_mapping(start_end_by_file)
+
+    if not return_int:
+        return start_end_by_file.label(time)
+    position = start_end_by_file.locate(time)
+    return None if position < 0 else position + 1
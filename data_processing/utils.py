@@ -1,22 +1,31 @@
 import pandas as pd
-import utm
-import plotly.express as px
+import cache
+import bathymetry
+import sensor_formats
+from bathymetry import MESH_PATH, read_mesh_file
+from conversions import latlon_to_zone_numbers, latlon_to_utm, date_time_to_unix, dates_times_to_unix
+from time_index import TimeIndex
 import plotly.graph_objects as go
-import datetime
-from bisect import bisect_left
 
-MESH_PATH = "../data/ring_depth.csv"
 
-def get_mesh(path, step, use_utm=True):
+def get_mesh(path, step=None, use_utm=True, cache_dir=None, max_vertices=20000, region=None):
     """Given the path to a tsv 
     file with the longitude, latitude, and depth,
     returns a plotly mesh object.
     
-    step : subsample at regular step sized intervals to speed up plotting
+    step : subsample at regular step sized intervals to speed up plotting. If not
+            given, the mesh is built from a gridded level of detail (see bathymetry.py) instead
     use_utm : determines what coordinate system to use for the mesh. Defaults to 
-            converting to utm (meters)"""
+            converting to utm (meters)
+    cache_dir : optional directory for caching the parsed tsv file (or the mesh levels)
+    max_vertices : vertex budget for choosing a level of detail
+    region : optional (lon_min, lon_max, lat_min, lat_max) to restrict the mesh to"""
 
-    ring_depth = pd.read_csv(path, header=None, names = ['lon', 'lat', 'depth'], sep='\t')
+    if step is None:
+        lod = bathymetry.BathymetryLOD.cached(path, cache_dir)
+        return lod.mesh(max_vertices, region, use_utm)
+
+    ring_depth = cache.cached_load(cache_dir, read_mesh_file, path)
     usable_ring_depth = ring_depth[pd.notna(ring_depth.depth)]
     usable_ring_depth = usable_ring_depth.reset_index(drop=True)
 
@@ -36,7 +45,10 @@ def get_mesh(path, step, use_utm=True):
         )
 
     # Convert to northing and easting from lat-lon
-    subsample_ring_depth[['northing', 'easting']] = subsample_ring_depth.apply(lambda row: utm.from_latlon(row['lat'], row['lon'])[:2], axis=1).tolist()
+    subsample_ring_depth['northing'], subsample_ring_depth['easting'] = latlon_to_utm(
+        subsample_ring_depth.lat, 
+        subsample_ring_depth.lon
+    )
     
     return go.Mesh3d(x=subsample_ring_depth.northing, y=subsample_ring_depth.easting, z=subsample_ring_depth.depth, opacity=.5)
 
@@ -47,79 +59,23 @@ NAV_COLUMNS = ["date", "time", "lat", "lon", "depth", "ua", "ub", "uc", "ud"]
 """
 
 
-def load_sensor_file(path, fields, explode_fields):
-    """
-    Parse data from a particular sensor stream
-
-    path : path to the file to read
-    fields : names of the columns to assign
-    explode_fields :  list of tuples of fields to split 
-                        along with the names of new fields
-    """
-
-    data = pd.read_csv(path, header = None, names = fields, comment="#")
-
-    # Some of the data streams don't include commas where they 
-    # should, so it's necessary to split them up after read-in
-    for field, new_names in explode_fields:
-        data[new_names] = data[field].str.split().tolist()
-    return data
-
 SCIENCE_VAR = ["CT2", "OBS", "OOS", "CSV"]
 
-RAW_COLUMNS = {}
-RAW_COLUMNS['OBS'] = ['lump1']
-RAW_COLUMNS['CT2'] = ['lump1', "conductivity", "pressure", "salinity", "sound_speed"]
-RAW_COLUMNS['OOS'] = ['lump1']
-RAW_COLUMNS['CSV'] = ['Vehicle', 'year', 'month', 'day', 'hour', 'minutes', 'seconds', 'time(seconds since Jan 1 1970)', 'latitude(deg)', 'longitude(deg)', 'X local(m)', 'Y local(m)', 'latitude origin(deg)', 'longitude origin(deg)', 'X UTM(m)', 'Y UTM(m)', 'UTMZone', 'depth(m)', 'altitude(m)', 'octans heading(deg)', 'octans pitch(deg)', 'octans roll(deg)', 'crossbow heading(deg)', 'crossbow pitch(deg)', 'crossbow roll(deg)', 'maggie x', 'maggie y', 'maggie z', 'maggie total', 'conductivity', 'temperature(deg C)', 'depth(m)_2', 'salinity', 'sound velocity', 'pressure', 'lss gain', 'lss backscatter', "None"]
-
-EXPAND_COLUMNS = {}
-EXPAND_COLUMNS['OBS'] = [('lump1', ["sensor1", "date", "time", "sensor2", "obs", "_1", "_2", "_3"])]
-EXPAND_COLUMNS['CT2'] = [('lump1', ["sensor1", "date", "time", "sensor2", "temperature"])]
-EXPAND_COLUMNS['OOS'] = [('lump1', ["sensor1", "date", "time", "sensor2", "_1", "_2", "_3", "_4", "oxygen", "_5", "air_saturation", "_6", "temperature_c", "_7", "cal_phase", "_8", "tc_phase", "_9", "c1rph", "_10", "c2rph", "_11", "c1amp", "_12", "c2amp", "_13", "raw_temp_mv"])]
-EXPAND_COLUMNS['CSV'] = []
-
-KEEP_DF = {}
-KEEP_DF["OBS"] = ["date", "time", "obs"]
-KEEP_DF["CT2"] = ["date", "time", "temperature", "salinity", "conductivity", "pressure"]
-KEEP_DF["OOS"] = ["date", "time", "oxygen"]
-KEEP_DF['CSV'] = RAW_COLUMNS['CSV']
-
-def load_from_file(path, format=None):
+
+def load_from_file(path, format=None, chunksize=None, columns=None):
     """Accepts a pre-prepared format for data processing.
     
-    format : {OBS, CT2, OOS, CSV}
+    format : name of a format in sensor_formats, defaults to the one for the file extension
+    chunksize, columns : see sensor_formats.read
     """
-    extension = path.split('.')[-1]
-
-    column_names = RAW_COLUMNS[extension]
-    expand_columns = EXPAND_COLUMNS[extension]
-
-
-    data = load_sensor_file(path, column_names, expand_columns)
-    data = data[KEEP_DF[extension]]
-
-    return data
+    return sensor_formats.read(path, format, chunksize=chunksize, columns=columns)
     
 
 
-def date_time_to_unix(date_str, time):
-    reformatted_date = '-'.join(date_str.split('/'))
-    d = datetime.date.fromisoformat(reformatted_date)
-    # Converts to unix UTC time
-    time_for_day = (d.toordinal() - datetime.date(1970, 1, 1).toordinal()) * 24*60*60
-    
-
-    time_piece = time.split(":")
-    time_of_day = datetime.timedelta(
-        hours = int(time_piece[0]),
-        minutes = int(time_piece[1]),
-        seconds = float(time_piece[2])
-    )
-    
-    return time_for_day + time_of_day.total_seconds()
-    
-
-def get_row_by_value(data, column, value):
-    index = bisect_left(data[column], value)
-    return data.iloc[index]
\ No newline at end of file
+def get_row_by_value(data, column, value, tolerance=None):
+    """Returns the row of data whose (sorted) column is closest to value,
+    or None if there isn't one within tolerance"""
+    index = TimeIndex(data[column].to_numpy(), assume_sorted=True).nearest(value, tolerance)
+    if index < 0:
+        return None
+    return data.iloc[index]
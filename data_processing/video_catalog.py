@@ -0,0 +1,215 @@
+"""
+A persistent catalog of the clips in a video directory.
+
+Probing every clip with ffprobe on each launch is slow (especially off a
+USB drive), so the results are kept in a sqlite file. Clips are keyed
+on filename, size and modification time, and only new or changed clips
+are probed, in parallel, when the catalog is updated.
+
+Keyframe positions (which let frame_server seek less) need every packet
+of a clip read, so the apps don't look for them. Adding --keyframes on the
+command line finds them for any clip that doesn't have them yet.
+
+Example command line (builds or updates the catalog, with keyframes):
+    python video_catalog.py --video_dir /Volumes/LaCie/video --workers 16 --keyframes
+"""
+import os
+import json
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+
+import pandas as pd
+from ffmpeg import probe, Error as FFmpegError
+
+import video_extraction
+
+# Starts with a '.' so that directory listings of videos skip it
+CATALOG_FILE = '.video_catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+    filename TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    start_time REAL,
+    end_time REAL,
+    fps REAL,
+    frame_count INTEGER,
+    duration REAL,
+    width INTEGER,
+    height INTEGER,
+    codec TEXT,
+    keyframes TEXT,
+    error TEXT
+)
+"""
+
+COLUMNS = [
+    'filename', 'size', 'mtime_ns', 'start_time', 'end_time', 'fps', 'frame_count',
+    'duration', 'width', 'height', 'codec', 'keyframes', 'error'
+]
+
+
+def get_keyframes(path):
+    """Times (in seconds from the start of the clip) of each keyframe, from
+    the packet flags, so nothing is decoded"""
+    file_data = probe(
+        path,
+        select_streams='v:0',
+        show_entries='packet=pts_time,flags'
+    )
+    return sorted(
+        float(packet['pts_time'])
+        for packet
+        in file_data.get('packets', [])
+        if 'K' in packet.get('flags', '') and packet.get('pts_time', 'N/A') != 'N/A'
+    )
+
+
+def probe_clip(path, keyframes=False):
+    """Collects the catalog entry for a single clip"""
+    file_data = probe(path)
+    video = next(stream for stream in file_data['streams'] if stream['codec_type'] == 'video')
+
+    fps = float(Fraction(video['avg_frame_rate']))
+    if 'nb_frames' in video:
+        frame_count = int(video['nb_frames'])
+    else:
+        frame_count = round(float(file_data['format']['duration']) * fps)
+
+    duration = frame_count/fps
+    start_time = video_extraction.start_time_from_probe(file_data)
+
+    return {
+        'start_time': start_time,
+        'end_time': start_time + duration,
+        'fps': fps,
+        'frame_count': frame_count,
+        'duration': duration,
+        'width': int(video['width']),
+        'height': int(video['height']),
+        'codec': video['codec_name'],
+        'keyframes': json.dumps(get_keyframes(path)) if keyframes else None,
+        'error': None,
+    }
+
+
+def _probe_or_error(path, keyframes):
+    # A clip that can't be read is still recorded, so
+    # that it isn't probed again until it changes
+    try:
+        return probe_clip(path, keyframes)
+    except (FFmpegError, ValueError, KeyError, StopIteration, ZeroDivisionError) as e:
+        return {'error': f"{type(e).__name__}: {e}"}
+
+
+class VideoCatalog():
+    """
+    Clip metadata for a directory of videos, stored in sqlite.
+
+    video_dir : directory of video clips
+    catalog_path : where to keep the catalog, defaults to a hidden file in video_dir
+    """
+    def __init__(self, video_dir, catalog_path=None):
+        self.video_dir = video_dir
+        self.catalog_path = catalog_path or os.path.join(video_dir, CATALOG_FILE)
+        self.connection = sqlite3.connect(self.catalog_path)
+        self.connection.execute(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, workers=8, keyframes=False):
+        """Probes any clips that are new or changed since the catalog was
+        last updated, and forgets clips that are gone. Returns the filenames probed.
+
+        keyframes : also find keyframe positions, probing clips catalogued without them"""
+        on_disk = {}
+        for filename in os.listdir(self.video_dir):
+            if filename.startswith('.'):
+                continue
+            stat = os.stat(os.path.join(self.video_dir, filename))
+            on_disk[filename] = (stat.st_size, stat.st_mtime_ns)
+
+        known = {}
+        missing_keyframes = set()
+        rows = self.connection.execute("SELECT filename, size, mtime_ns, keyframes, error FROM clips")
+        for filename, size, mtime_ns, clip_keyframes, error in rows:
+            known[filename] = (size, mtime_ns)
+            if clip_keyframes is None and error is None:
+                missing_keyframes.add(filename)
+
+        stale = sorted(
+            filename
+            for filename, key
+            in on_disk.items()
+            if known.get(filename) != key or (keyframes and filename in missing_keyframes)
+        )
+        gone = [filename for filename in known if filename not in on_disk]
+
+        paths = [os.path.join(self.video_dir, filename) for filename in stale]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            entries = list(executor.map(lambda path: _probe_or_error(path, keyframes), paths))
+
+        with self.connection:
+            self.connection.executemany("DELETE FROM clips WHERE filename = ?", [(f,) for f in gone])
+            for filename, entry in zip(stale, entries):
+                size, mtime_ns = on_disk[filename]
+                row = {column: None for column in COLUMNS}
+                row.update(entry, filename=filename, size=size, mtime_ns=mtime_ns)
+                self.connection.execute(
+                    f"INSERT OR REPLACE INTO clips VALUES ({', '.join('?' for _ in COLUMNS)})",
+                    [row[column] for column in COLUMNS]
+                )
+
+        return stale
+
+    def clips(self):
+        """Every catalogued clip as a DataFrame, by filename"""
+        return pd.read_sql("SELECT * FROM clips ORDER BY filename", self.connection)
+
+    def clip(self, filename):
+        """The catalog entry for one clip as a dict (keyframes decoded), or None"""
+        row = self.connection.execute(
+            "SELECT * FROM clips WHERE filename = ?", (filename,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        entry = dict(zip(COLUMNS, row))
+        entry['keyframes'] = json.loads(entry['keyframes']) if entry['keyframes'] else None
+        return entry
+
+    def start_end_by_file(self):
+        """A map from filename to the unix start and end time of each readable clip,
+        the same as rov_sim.get_frames used to compute"""
+        rows = self.connection.execute(
+            "SELECT filename, start_time, end_time FROM clips "
+            "WHERE error IS NULL ORDER BY filename"
+        )
+        return {filename: (start, end) for filename, start, end in rows}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video_dir', required=True, type=str, help="Directory with video clips")
+    parser.add_argument('--catalog', default=None, type=str,
+        help=f"Where to keep the catalog, defaults to {CATALOG_FILE} in video_dir")
+    parser.add_argument('--workers', default=8, type=int, help="Number of clips to probe at once")
+    parser.add_argument('--keyframes', action='store_true',
+        help="Also find keyframe positions (reads every clip in full)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    catalog = VideoCatalog(args.video_dir, args.catalog)
+    probed = catalog.update(workers=args.workers, keyframes=args.keyframes)
+    clips = catalog.clips()
+
+    print(f"Probed {len(probed)} clips, {len(clips)} in catalog")
+    for _, clip in clips[pd.notna(clips.error)].iterrows():
+        print(f"Unreadable: {clip.filename} ({clip.error})")
@@ -1,14 +1,24 @@
 from ffmpeg import probe
 import utils
 
-import scipy.linalg
+import argparse
+import threading
+from queue import Queue, Full
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
 import numpy as np
-from collections import namedtuple
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 Image = namedtuple('Image', ['ru', 'rs', 'rv', 'gu', 'gs', 'gv', 'bu', 'bs', 'bv'])
 
 def get_start_time(filename, unix=True):
-    file_data = probe(filename)
+    return start_time_from_probe(probe(filename), unix)
 
+def start_time_from_probe(file_data, unix=True):
+    """Reads the start time from the output of ffmpeg.probe"""
     for stream in file_data['streams']:
         if 'timecode' in stream['tags']:
             timestamp = stream['tags']['timecode']
@@ -19,33 +29,301 @@ def get_start_time(filename, unix=True):
 
     raise ValueError("No timestamp found")
 
-def process_video(filename):
+def iter_frames(filename, time_step=None, start_time=None):
+    """
+    Decodes a clip front to back, never seeking, yielding (unix time, frame index, rgb frame).
+
+    time_step : keep one frame every time_step seconds (every frame if None)
+    start_time : unix time of the first frame, read from the clip's timecode if None
+    """
+    if start_time is None:
+        start_time = get_start_time(filename)
+
+    cap = cv2.VideoCapture(filename)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open {filename}")
+    fps = cap.get(cv2.CAP_PROP_FPS)
+
+    try:
+        index = 0
+        kept = 0
+        while True:
+            # Frames that are skipped only need to be grabbed, not decoded into an image
+            if time_step is not None and index < int(round(kept * time_step * fps)):
+                if not cap.grab():
+                    break
+                index += 1
+                continue
+
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            # CV2 orders the channels as bgr, this gives rgb
+            yield start_time + index/fps, index, frame[:, :, ::-1]
+            index += 1
+            kept += 1
+    finally:
+        cap.release()
+
+
+def brightness_stage(frame):
+    """Simple per-frame statistics. Contrast and sharpness (variance of the
+    laplacian) both drop in turbid water, so they work as rough turbidity proxies"""
+    gray = cv2.cvtColor(np.ascontiguousarray(frame), cv2.COLOR_RGB2GRAY)
+    return {
+        'brightness': float(gray.mean()),
+        'contrast': float(gray.std()),
+        'sharpness': float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+    }
+
+
+def downscale_stage(width=160):
+    """A stage storing an rgb thumbnail of the given width as raw bytes"""
+    def downscale(frame):
+        height, full_width = frame.shape[:2]
+        size = (width, max(int(round(height * width / full_width)), 1))
+        thumbnail = cv2.resize(np.ascontiguousarray(frame), size, interpolation=cv2.INTER_AREA)
+        return {
+            'thumbnail': thumbnail.tobytes(),
+            'thumbnail_height': thumbnail.shape[0],
+            'thumbnail_width': thumbnail.shape[1],
+        }
+    return downscale
+
+
+def compression_stage(modes=50):
+    """A stage storing the float32 svd factors of each frame (stacked by channel) as raw bytes"""
+    def compress(frame):
+        image = compress_frame(frame, modes)
+        return {
+            'svd_u': np.stack([image.ru, image.gu, image.bu]).tobytes(),
+            'svd_s': np.stack([image.rs, image.gs, image.bs]).tobytes(),
+            'svd_v': np.stack([image.rv, image.gv, image.bv]).tobytes(),
+            'svd_modes': len(image.rs),
+        }
+    return compress
+
+
+DEFAULT_STAGES = [brightness_stage]
+
+# Marks the end of the decoded frames on the queue
+_DONE = object()
+
+
+def _put(queue, stop, item):
+    # Gives up once the consumer has stopped, instead of blocking on a full queue forever
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _decode_into(queue, stop, frames):
+    try:
+        for item in frames:
+            if not _put(queue, stop, item):
+                return
+        _put(queue, stop, _DONE)
+    except Exception as e:
+        _put(queue, stop, e)
+
+
+def _apply_stages(stages, unix_time, index, frame):
+    record = {'unix_time': unix_time, 'frame': index}
+    for stage in stages:
+        record.update(stage(frame))
+    return record
+
+
+def process_video(filename, stages=DEFAULT_STAGES, time_step=None, start_time=None, workers=4, queue_size=8):
+    """
+    Streams per-frame records for a clip, in frame order. Each record has the
+    frame's unix_time and index, plus whatever columns each stage returns for it.
+
+    A thread decodes frames into a bounded queue while a pool of workers runs
+    the stages (cv2 and numpy release the GIL), so at most queue_size + 2*workers
+    frames are ever held in memory, however long the clip is.
     """
-    This function is designed to """
-    pass
+    queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+    decoder = threading.Thread(
+        target=_decode_into,
+        args=(queue, stop, iter_frames(filename, time_step, start_time)),
+        daemon=True
+    )
+    decoder.start()
+
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                item = queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                pending.append(executor.submit(_apply_stages, stages, *item))
+                if len(pending) >= 2*workers:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        stop.set()
+        for future in pending:
+            future.cancel()
+        decoder.join()
+
+
+def write_frame_table(records, output_path, batch_rows=256):
+    """Streams records (such as from process_video) to a parquet file, batch_rows at a time.
+    Returns the number of rows written."""
+    writer = None
+    batch = []
+    rows = 0
+    try:
+        for record in records:
+            batch.append(record)
+            if len(batch) == batch_rows:
+                writer = _write_batch(writer, output_path, batch)
+                rows += len(batch)
+                batch = []
+        if batch or writer is None:
+            writer = _write_batch(writer, output_path, batch)
+            rows += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def _write_batch(writer, output_path, batch):
+    table = pa.Table.from_pandas(
+        pd.DataFrame(batch),
+        schema=writer.schema if writer is not None else None,
+        preserve_index=False
+    )
+    if writer is None:
+        writer = pq.ParquetWriter(output_path, table.schema)
+    writer.write_table(table)
+    return writer
+
+
+def _orthonormalize(matrices):
+    # np.linalg.qr only broadcasts over stacks on newer numpy
+    return np.stack([np.linalg.qr(matrix)[0] for matrix in matrices])
+
+
+def compress_channels(channels, modes=50, oversample=10, power_iterations=2, basis=None, rng=None):
+    """
+    Rank modes factors of a stack of channels, shaped (channels, height, width),
+    by randomized SVD. Only the leading modes are ever computed, instead of the
+    full decomposition.
+
+    basis : right singular vectors (channels, modes, width) of a similar
+            frame, such as the one before it, used to start the range finder
+    Returns float32 U (channels, height, modes), S (channels, modes), V (channels, modes, width)
+    """
+    channels = np.asarray(channels, dtype=np.float32)
+    count, height, width = channels.shape
+    modes = min(modes, height, width)
+    samples = modes + oversample
+
+    if samples >= min(height, width):
+        # Nothing to save over an exact decomposition
+        U, S, V = np.linalg.svd(channels, full_matrices=False)
+        return U[:, :, :modes], S[:, :modes], V[:, :modes]
+
+    rng = rng if rng is not None else np.random.default_rng()
+    test = rng.standard_normal((count, width, samples), dtype=np.float32)
+    if basis is not None:
+        basis_modes = min(basis.shape[1], modes)
+        test[:, :, :basis_modes] = np.swapaxes(basis[:, :basis_modes], 1, 2)
+
+    transposed = np.swapaxes(channels, 1, 2)
+    Q = _orthonormalize(channels @ test)
+    for _ in range(power_iterations):
+        Q = _orthonormalize(channels @ _orthonormalize(transposed @ Q))
+
+    U, S, V = np.linalg.svd(np.swapaxes(Q, 1, 2) @ channels, full_matrices=False)
+    return Q @ U[:, :, :modes], S[:, :modes], V[:, :modes]
 
 
 def compress_channel(channel, modes=50):
-    U, S, V = scipy.linalg.svd(channel)
-    return (U[:, :modes], S[:modes], V[:modes])
-    
-def compress_frame(frame):
-    red_channel = frame[:, :, 0].reshape(len(frame), -1)
-    green_channel = frame[:, :, 1].reshape(len(frame), -1)
-    blue_channel = frame[:, :, 2].reshape(len(frame), -1)
-    
-    ru, rs, rv = compress_channel(red_channel)
-    gu, gs, gv = compress_channel(green_channel)
-    bu, bs, bv = compress_channel(blue_channel)
-    
-    return Image(ru, rs, rv, gu, gs, gv, bu, bs, bv)
+    U, S, V = compress_channels(channel[np.newaxis], modes)
+    return (U[0], S[0], V[0])
+
+
+def compress_frame(frame, modes=50, basis=None):
+    """Factors each colour channel of an (height, width, 3) frame at once"""
+    U, S, V = compress_channels(np.moveaxis(frame, 2, 0), modes, basis=basis)
+    return Image(U[0], S[0], V[0], U[1], S[1], V[1], U[2], S[2], V[2])
+
 
 def decompress_image(image):
-    height = len(image.ru)
-    width = len(image.rv[0, :])
-    reconstruction = np.zeros((height, width, 3))
-    reconstruction[:, :, 0] = image.ru@np.diag(image.rs)@image.rv
-    reconstruction[:, :, 1] = image.gu@np.diag(image.gs)@image.gv
-    reconstruction[:, :, 2] = image.bu@np.diag(image.bs)@image.bv
-    return reconstruction.astype('uint8')
+    U = np.stack([image.ru, image.gu, image.bu])
+    S = np.stack([image.rs, image.gs, image.bs])
+    V = np.stack([image.rv, image.gv, image.bv])
+
+    # Scaling the columns of U is the same as multiplying by diag(S)
+    reconstruction = (U * S[:, np.newaxis, :]) @ V
+    return np.clip(np.moveaxis(reconstruction, 0, 2), 0, 255).astype('uint8')
+
+
+def image_nbytes(image):
+    return sum(factor.nbytes for factor in image)
+
+
+def compress_clip(frames, modes=50, warm_start=True):
+    """
+    Compresses an iterable of rgb frames one at a time, so only the current
+    frame is ever held in memory. Consecutive frames are similar, so by default
+    each frame's range finder starts from the previous frame's basis.
+
+    Yields (Image, stats) for each frame, where stats has the relative error
+    (Frobenius norm of the residual over that of the frame) and the compression ratio.
+    """
+    basis = None
+    for frame in frames:
+        image = compress_frame(frame, modes, basis)
+        if warm_start:
+            basis = np.stack([image.rv, image.gv, image.bv])
+
+        # The factors project the frame onto the leading left singular vectors,
+        # so the residual is whatever energy the kept singular values don't hold
+        total = np.sum(np.square(frame, dtype=np.float64))
+        kept = sum(np.sum(np.square(s, dtype=np.float64)) for s in (image.rs, image.gs, image.bs))
+        error = np.sqrt(max(total - kept, 0) / total) if total > 0 else 0.0
+
+        yield image, {'error': float(error), 'ratio': frame.nbytes / image_nbytes(image)}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video_file', required=True, type=str, help="The clip to process")
+    parser.add_argument('--output_file', required=True, type=str, help="Parquet file to write a row per frame to")
+    parser.add_argument('--time_step', default=None, type=float,
+        help="Seconds between processed frames (defaults to every frame)")
+    parser.add_argument('--thumbnail_width', default=None, type=int, help="Also store thumbnails this wide")
+    parser.add_argument('--modes', default=None, type=int, help="Also store svd factors with this many modes")
+    parser.add_argument('--workers', default=4, type=int, help="Number of frames to process at once")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    stages = list(DEFAULT_STAGES)
+    if args.thumbnail_width is not None:
+        stages.append(downscale_stage(args.thumbnail_width))
+    if args.modes is not None:
+        stages.append(compression_stage(args.modes))
 
+    records = process_video(args.video_file, stages, time_step=args.time_step, workers=args.workers)
+    rows = write_frame_table(records, args.output_file)
+    print(f"Wrote {rows} frames to {args.output_file}")
@@ -0,0 +1,215 @@
+"""
+Offline extraction of downscaled proxy frames from dive video.
+
+Every clip in the video catalog is decoded once, sequentially, and a frame
+is kept at a fixed time step (1 Hz by default) at a few widths. Each width
+is stored as chunks of frames in .npy files:
+
+    proxy_dir/<clip>/proxies.json        what was extracted, and from which file
+    proxy_dir/<clip>/times.npy           seconds into the clip of each proxy frame
+    proxy_dir/<clip>/<width>/00000.npy   (frames, height, width, 3) rgb uint8
+
+Example command line:
+    python video_proxies.py --video_dir /Volumes/LaCie/video --proxy_dir ../data/proxies --workers 8
+"""
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import video_catalog
+
+PROXY_WIDTHS = (160, 320, 640)
+
+# Seconds between proxy frames
+DEFAULT_STEP = 1.0
+
+CHUNK_FRAMES = 256
+
+META_FILE = 'proxies.json'
+
+
+def _chunk_path(clip_dir, width, chunk):
+    return os.path.join(clip_dir, str(width), f"{chunk:05d}.npy")
+
+
+def extract_clip_proxies(video_path, clip_dir, fps, step=DEFAULT_STEP, widths=PROXY_WIDTHS, chunk_frames=CHUNK_FRAMES):
+    """Decodes a clip front to back, writing a downscaled frame
+    every step seconds at each of the given widths. Returns the number of proxy frames."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open {video_path}")
+
+    for width in widths:
+        os.makedirs(os.path.join(clip_dir, str(width)), exist_ok=True)
+
+    buffers = {width: [] for width in widths}
+    times = []
+    chunk = 0
+    index = 0
+
+    while True:
+        next_time = len(times) * step
+        # Skipped frames only need to be grabbed, not decoded into an image
+        if index < int(round(next_time * fps)):
+            if not cap.grab():
+                break
+            index += 1
+            continue
+
+        ret, frame = cap.read()
+        if not ret:
+            break
+        index += 1
+
+        height, full_width = frame.shape[:2]
+        for width in widths:
+            size = (width, max(int(round(height * width / full_width)), 1))
+            # CV2 orders the channels as bgr, this stores rgb
+            buffers[width].append(cv2.resize(frame, size, interpolation=cv2.INTER_AREA)[:, :, ::-1])
+        times.append(next_time)
+
+        if len(buffers[widths[0]]) == chunk_frames:
+            for width in widths:
+                np.save(_chunk_path(clip_dir, width, chunk), np.stack(buffers[width]))
+                buffers[width] = []
+            chunk += 1
+
+    if buffers[widths[0]]:
+        for width in widths:
+            np.save(_chunk_path(clip_dir, width, chunk), np.stack(buffers[width]))
+
+    cap.release()
+    np.save(os.path.join(clip_dir, 'times.npy'), np.array(times))
+    return len(times)
+
+
+def _extract(video_dir, proxy_dir, clip, step, widths, chunk_frames):
+    clip_dir = os.path.join(proxy_dir, clip['filename'])
+    count = extract_clip_proxies(
+        os.path.join(video_dir, clip['filename']),
+        clip_dir,
+        clip['fps'],
+        step,
+        widths,
+        chunk_frames
+    )
+
+    # Written last, so an interrupted extraction is redone
+    with open(os.path.join(clip_dir, META_FILE), 'w') as f:
+        json.dump({
+            'size': int(clip['size']),
+            'mtime_ns': int(clip['mtime_ns']),
+            'step': step,
+            'widths': list(widths),
+            'chunk_frames': chunk_frames,
+            'count': count,
+        }, f)
+    return clip['filename']
+
+
+def _is_current(proxy_dir, clip, step, widths):
+    try:
+        with open(os.path.join(proxy_dir, clip['filename'], META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return (
+        meta['size'] == clip['size']
+        and meta['mtime_ns'] == clip['mtime_ns']
+        and meta['step'] == step
+        and meta['widths'] == list(widths)
+    )
+
+
+def extract_proxies(video_dir, proxy_dir, catalog_path=None, step=DEFAULT_STEP, widths=PROXY_WIDTHS,
+                    workers=None, chunk_frames=CHUNK_FRAMES):
+    """Extracts proxies for every readable clip in the video catalog that
+    doesn't already have current ones, one clip per process. Returns the clips extracted."""
+    catalog = video_catalog.VideoCatalog(video_dir, catalog_path)
+    catalog.update()
+    clips = catalog.clips()
+    catalog.close()
+
+    clips = [
+        clip
+        for clip
+        in clips[clips.error.isna()].to_dict('records')
+        if not _is_current(proxy_dir, clip, step, widths)
+    ]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_extract, video_dir, proxy_dir, clip, step, tuple(widths), chunk_frames)
+            for clip
+            in clips
+        ]
+        return [future.result() for future in futures]
+
+
+class ProxyStore():
+    """Reads proxy frames written by extract_proxies"""
+    def __init__(self, proxy_dir):
+        self.proxy_dir = proxy_dir
+        self.clips = {}
+
+    def _clip(self, filename):
+        if filename not in self.clips:
+            clip_dir = os.path.join(self.proxy_dir, filename)
+            try:
+                with open(os.path.join(clip_dir, META_FILE)) as f:
+                    meta = json.load(f)
+            except OSError:
+                self.clips[filename] = None
+                return None
+            meta['times'] = np.load(os.path.join(clip_dir, 'times.npy'))
+            self.clips[filename] = meta
+        return self.clips[filename]
+
+    def get_frame(self, filename, seconds, width=None):
+        """The proxy frame closest to seconds into the clip, at the largest width
+        no bigger than the one asked for (the smallest if none are). None if the
+        clip has no proxies."""
+        meta = self._clip(filename)
+        if meta is None or meta['count'] == 0:
+            return None
+
+        widths = sorted(meta['widths'])
+        if width is not None:
+            widths = [w for w in widths if w <= width] or widths[:1]
+        width = widths[-1]
+
+        index = int(np.abs(meta['times'] - seconds).argmin())
+        chunk, offset = divmod(index, meta['chunk_frames'])
+        frames = np.load(_chunk_path(os.path.join(self.proxy_dir, filename), width, chunk), mmap_mode='r')
+        return np.array(frames[offset])
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video_dir', required=True, type=str, help="Directory with video clips")
+    parser.add_argument('--proxy_dir', required=True, type=str, help="Where to write the proxy frames")
+    parser.add_argument('--catalog', default=None, type=str,
+        help="Where the video catalog is kept, defaults to a hidden file in video_dir")
+    parser.add_argument('--step', default=DEFAULT_STEP, type=float, help="Seconds between proxy frames")
+    parser.add_argument('--widths', default=list(PROXY_WIDTHS), type=int, nargs='+',
+        help="Widths (in pixels) to store each proxy frame at")
+    parser.add_argument('--workers', default=None, type=int, help="Number of clips to extract at once")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    extracted = extract_proxies(
+        args.video_dir,
+        args.proxy_dir,
+        catalog_path=args.catalog,
+        step=args.step,
+        widths=sorted(args.widths),
+        workers=args.workers
+    )
+    print(f"Extracted proxies for {len(extracted)} clips")